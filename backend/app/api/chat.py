@@ -1,16 +1,26 @@
 """
 Chat API endpoints
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import List, Optional
-from app.db.session import get_db
+from datetime import datetime
+from app.api.etag import weak_etag, check_etag
+from app.db.session import get_db, SessionLocal
 from app.models.conversation import Conversation, Message
 from app.models.document import Document
-from app.services.chat_engine import ChatEngine
+from app.services.chat_engine import ChatEngine, FALLBACK_ANSWER
+import anyio
+import json
+import time
+import logging
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 class ChatRequest(BaseModel):
@@ -27,14 +37,8 @@ class ChatResponse(BaseModel):
     processing_time: float
 
 
-@router.post("")
-async def send_message(
-    request: ChatRequest,
-    db: Session = Depends(get_db)
-) -> ChatResponse:
-    """
-    Send a chat message and get a response
-    """
+def _start_turn(request: ChatRequest, db: Session) -> Conversation:
+    """Validate the request and store the user message (flushed, not committed)."""
     if request.document_id:
         document = db.query(Document).filter(Document.id == request.document_id).first()
         if not document:
@@ -53,12 +57,11 @@ async def send_message(
             raise HTTPException(status_code=404, detail="Conversation not found")
     else:
         conversation = Conversation(
-            title=request.message[:50],
+            title=request.message,
             document_id=request.document_id
         )
         db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
+        db.flush()
     
     user_message = Message(
         conversation_id=conversation.id,
@@ -66,39 +69,143 @@ async def send_message(
         content=request.message
     )
     db.add(user_message)
-    db.commit()
+    db.flush()
     
+    return conversation
+
+
+def _save_answer(db: Session, conversation_id: int, answer: str, sources: List[dict]) -> int:
+    """Store the assistant message, touch the conversation and commit the turn."""
+    assistant_message = Message(
+        conversation_id=conversation_id,
+        role="assistant",
+        content=answer,
+        sources=sources
+    )
+    db.add(assistant_message)
+    db.query(Conversation).filter(Conversation.id == conversation_id).update(
+        {Conversation.updated_at: datetime.utcnow()}, synchronize_session=False
+    )
+    db.flush()
+    
+    # Read the id before commit expires the instance
+    message_id = assistant_message.id
+    db.commit()
+    return message_id
+
+
+def _save_streamed_answer(conversation_id: int, answer: str, sources: List[dict]) -> int:
+    """Store a streamed answer in its own session; the request session is closed by then."""
+    db = SessionLocal()
+    try:
+        return _save_answer(db, conversation_id, answer, sources)
+    finally:
+        db.close()
+
+
+def _release_session(db: Session):
+    """Commit the user message and close the request session before streaming."""
+    db.commit()
+    db.close()
+
+
+def _sse(payload: dict) -> str:
+    """Format a server-sent event."""
+    return f"data: {json.dumps(payload, default=str)}\n\n"
+
+
+@router.post("")
+async def send_message(
+    request: ChatRequest,
+    db: Session = Depends(get_db)
+) -> ChatResponse:
+    """
+    Send a chat message and get a response
+    """
+    # Created before any writes: VectorStore setup may end the current transaction
     chat_engine = ChatEngine(db)
+    conversation = await run_in_threadpool(_start_turn, request, db)
+    conversation_id = conversation.id
+    
     result = await chat_engine.process_message(
-        conversation_id=conversation.id,
+        conversation_id=conversation_id,
         message=request.message,
         document_id=request.document_id or conversation.document_id
     )
     
-    assistant_message = Message(
-        conversation_id=conversation.id,
-        role="assistant",
-        content=result["answer"],
-        sources=result.get("sources", [])
+    message_id = await run_in_threadpool(
+        _save_answer, db, conversation_id, result["answer"], result.get("sources", [])
     )
-    db.add(assistant_message)
-    db.commit()
-    db.refresh(assistant_message)
-    
-    conversation.updated_at = assistant_message.created_at
-    db.commit()
     
     return ChatResponse(
-        conversation_id=conversation.id,
-        message_id=assistant_message.id,
+        conversation_id=conversation_id,
+        message_id=message_id,
         answer=result["answer"],
         sources=result.get("sources", []),
         processing_time=result.get("processing_time", 0.0)
     )
 
 
+@router.post("/stream")
+async def stream_message(
+    request: ChatRequest,
+    db: Session = Depends(get_db)
+) -> StreamingResponse:
+    """
+    Send a chat message and stream the response as server-sent events
+    """
+    start_time = time.time()
+    
+    chat_engine = ChatEngine(db)
+    conversation = await run_in_threadpool(_start_turn, request, db)
+    conversation_id = conversation.id
+    document_id = request.document_id or conversation.document_id
+    
+    try:
+        turn = await chat_engine.prepare_turn(conversation_id, request.message, document_id)
+    except Exception as e:
+        logger.error(f"Error preparing message: {str(e)}")
+        turn = None
+    
+    # Commit the user message and hand the connection back to the pool during generation
+    await run_in_threadpool(_release_session, db)
+    
+    async def event_stream():
+        parts = []
+        sources = turn["sources"] if turn else []
+        try:
+            if turn is None:
+                raise RuntimeError("Message preparation failed")
+            async for delta in chat_engine.stream_answer(request.message, document_id, turn):
+                parts.append(delta)
+                yield _sse({"delta": delta})
+        except Exception as e:
+            logger.error(f"Error streaming response: {str(e)}")
+            if not parts:
+                parts.append(FALLBACK_ANSWER)
+                sources = []
+                yield _sse({"delta": FALLBACK_ANSWER})
+        finally:
+            # Runs on client disconnect too, so a partial answer is still recorded;
+            # the request session is gone by now, so the save uses its own
+            with anyio.CancelScope(shield=True):
+                message_id = await run_in_threadpool(
+                    _save_streamed_answer, conversation_id, "".join(parts), sources
+                )
+        
+        yield _sse({
+            "done": True,
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "sources": sources,
+            "processing_time": round(time.time() - start_time, 2)
+        })
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @router.get("/conversations")
-async def list_conversations(
+def list_conversations(
     skip: int = 0,
     limit: int = 10,
     db: Session = Depends(get_db)
@@ -106,10 +213,14 @@ async def list_conversations(
     """
     Get list of all conversations
     """
-    conversations = db.query(Conversation).order_by(
+    rows = db.query(Conversation, func.count(Message.id)).outerjoin(
+        Message, Message.conversation_id == Conversation.id
+    ).group_by(Conversation.id).order_by(
         Conversation.updated_at.desc()
     ).offset(skip).limit(limit).all()
     
+    total = db.query(func.count(Conversation.id)).scalar()
+    
     return {
         "conversations": [
             {
@@ -118,22 +229,34 @@ async def list_conversations(
                 "created_at": conv.created_at,
                 "updated_at": conv.updated_at,
                 "document_id": conv.document_id,
-                "message_count": len(conv.messages)
+                "message_count": message_count
             }
-            for conv in conversations
+            for conv, message_count in rows
         ],
-        "total": db.query(Conversation).count()
+        "total": total
     }
 
 
 @router.get("/conversations/{conversation_id}")
-async def get_conversation(
+def get_conversation(
     conversation_id: int,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
     Get conversation details with all messages
     """
+    row = db.query(Conversation.updated_at, func.count(Message.id)).outerjoin(
+        Message, Message.conversation_id == Conversation.id
+    ).filter(Conversation.id == conversation_id).group_by(Conversation.id).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    not_modified = check_etag(request, response, weak_etag(*row))
+    if not_modified:
+        return not_modified
+    
     conversation = db.query(Conversation).filter(
         Conversation.id == conversation_id
     ).first()
@@ -160,7 +283,7 @@ async def get_conversation(
 
 
 @router.delete("/conversations/{conversation_id}")
-async def delete_conversation(
+def delete_conversation(
     conversation_id: int,
     db: Session = Depends(get_db)
 ):
@@ -1,22 +1,27 @@
 """
 Document management API endpoints
 """
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks, Request, Response
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
 from typing import List
+from app.api.etag import weak_etag, check_etag
 from app.db.session import get_db, SessionLocal
 from app.models.document import Document
 from app.services.document_processor import DocumentProcessor
+from app.services.semantic_cache import semantic_cache
 from app.core.config import settings
 import os
 import uuid
 from datetime import datetime
 import logging
-import asyncio
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+
 
 async def process_document_task(document_id: int, file_path: str):
     """Background task to process document."""
@@ -25,6 +30,8 @@ async def process_document_task(document_id: int, file_path: str):
         processor = DocumentProcessor(db)
         result = await processor.process_document(file_path, document_id)
         logger.info(f"Document {document_id} processing result: {result}")
+        # Answers cached while the old (or no) content was indexed are now stale
+        await semantic_cache.invalidate(document_id)
     except Exception as e:
         logger.error(f"Error processing document {document_id}: {str(e)}")
         document = db.query(Document).filter(Document.id == document_id).first()
@@ -36,20 +43,21 @@ async def process_document_task(document_id: int, file_path: str):
         db.close()
 
 
-def run_async_task(coro):
-    """Run async task in background."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(coro)
-    finally:
-        loop.close()
+def _unlink_many(paths: List[str]):
+    """Background task to remove files, ignoring ones already gone."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {str(e)}")
 
 
 @router.post("/upload")
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    background_tasks: BackgroundTasks = None,
     db: Session = Depends(get_db)
 ):
     """
@@ -58,10 +66,6 @@ async def upload_document(
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     
-    contents = await file.read()
-    if len(contents) > settings.MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail=f"File size exceeds {settings.MAX_FILE_SIZE / 1024 / 1024}MB limit")
-    
     file_id = str(uuid.uuid4())
     file_extension = os.path.splitext(file.filename)[1]
     unique_filename = f"{file_id}{file_extension}"
@@ -69,8 +73,21 @@ async def upload_document(
     os.makedirs(os.path.join(settings.UPLOAD_DIR, "documents"), exist_ok=True)
     file_path = os.path.join(settings.UPLOAD_DIR, "documents", unique_filename)
     
-    with open(file_path, "wb") as f:
-        f.write(contents)
+    total = 0
+    try:
+        with open(file_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > settings.MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File size exceeds {settings.MAX_FILE_SIZE / 1024 / 1024}MB limit"
+                    )
+                await run_in_threadpool(f.write, chunk)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
     
     document = Document(
         filename=file.filename,
@@ -81,13 +98,7 @@ async def upload_document(
     db.commit()
     db.refresh(document)
     
-    if background_tasks:
-        import threading
-        thread = threading.Thread(
-            target=run_async_task,
-            args=(process_document_task(document.id, file_path),)
-        )
-        thread.start()
+    background_tasks.add_task(process_document_task, document.id, file_path)
     
     return {
         "id": document.id,
@@ -98,7 +109,7 @@ async def upload_document(
 
 
 @router.post("/{document_id}/process")
-async def trigger_processing(
+def trigger_processing(
     document_id: int,
     background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
@@ -118,12 +129,8 @@ async def trigger_processing(
     document.error_message = None
     db.commit()
     
-    import threading
-    thread = threading.Thread(
-        target=run_async_task,
-        args=(process_document_task(document.id, document.file_path),)
-    )
-    thread.start()
+    background_tasks.add_task(semantic_cache.invalidate, document.id)
+    background_tasks.add_task(process_document_task, document.id, document.file_path)
     
     return {
         "id": document.id,
@@ -134,7 +141,9 @@ async def trigger_processing(
 
 
 @router.get("")
-async def list_documents(
+def list_documents(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 10,
     db: Session = Depends(get_db)
@@ -142,6 +151,11 @@ async def list_documents(
     """
     Get list of all documents
     """
+    last_updated, total = db.query(func.max(Document.updated_at), func.count(Document.id)).one()
+    not_modified = check_etag(request, response, weak_etag(last_updated, total))
+    if not_modified:
+        return not_modified
+    
     documents = db.query(Document).order_by(Document.upload_date.desc()).offset(skip).limit(limit).all()
     
     return {
@@ -158,19 +172,32 @@ async def list_documents(
             }
             for doc in documents
         ],
-        "total": db.query(Document).count()
+        "total": total
     }
 
 
 @router.get("/{document_id}")
-async def get_document(
+def get_document(
     document_id: int,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
     Get document details including extracted images and tables
     """
-    document = db.query(Document).filter(Document.id == document_id).first()
+    row = db.query(Document.updated_at).filter(Document.id == document_id).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    not_modified = check_etag(request, response, weak_etag(row.updated_at, document_id))
+    if not_modified:
+        return not_modified
+    
+    document = db.query(Document).options(
+        selectinload(Document.images),
+        selectinload(Document.tables)
+    ).filter(Document.id == document_id).first()
     
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -186,7 +213,7 @@ async def get_document(
         "images": [
             {
                 "id": img.id,
-                "url": f"/uploads/images/{os.path.basename(img.file_path)}",
+                "url": f"/uploads/images/{img.file_name}",
                 "page": img.page_number,
                 "caption": img.caption,
                 "width": img.width,
@@ -197,7 +224,7 @@ async def get_document(
         "tables": [
             {
                 "id": tbl.id,
-                "url": f"/uploads/tables/{os.path.basename(tbl.image_path)}",
+                "url": f"/uploads/tables/{tbl.file_name}",
                 "page": tbl.page_number,
                 "caption": tbl.caption,
                 "rows": tbl.rows,
@@ -210,30 +237,30 @@ async def get_document(
 
 
 @router.delete("/{document_id}")
-async def delete_document(
+def delete_document(
     document_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     """
     Delete a document and all associated data
     """
-    document = db.query(Document).filter(Document.id == document_id).first()
+    document = db.query(Document).options(
+        selectinload(Document.images),
+        selectinload(Document.tables)
+    ).filter(Document.id == document_id).first()
     
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    if os.path.exists(document.file_path):
-        os.remove(document.file_path)
-    
-    for img in document.images:
-        if os.path.exists(img.file_path):
-            os.remove(img.file_path)
-    
-    for tbl in document.tables:
-        if os.path.exists(tbl.image_path):
-            os.remove(tbl.image_path)
+    paths = [document.file_path]
+    paths.extend(img.file_path for img in document.images)
+    paths.extend(tbl.image_path for tbl in document.tables)
     
     db.delete(document)
     db.commit()
     
+    background_tasks.add_task(_unlink_many, paths)
+    background_tasks.add_task(semantic_cache.invalidate, document_id)
+    
     return {"message": "Document deleted successfully"}
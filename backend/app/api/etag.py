@@ -0,0 +1,29 @@
+"""
+Conditional GET helpers for read endpoints
+"""
+from fastapi import Request, Response
+from typing import Optional
+from datetime import datetime
+
+CACHE_CONTROL = "private, max-age=2"
+
+
+def weak_etag(updated_at: Optional[datetime], count: int) -> str:
+    """Build a weak ETag from the latest modification time and a row count."""
+    stamp = updated_at.timestamp() if updated_at else 0
+    return f'W/"{stamp}-{count}"'
+
+
+def check_etag(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """
+    Attach cache headers and return a 304 response if the client copy is current.
+    """
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in candidates or etag in candidates:
+            return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
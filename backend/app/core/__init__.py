@@ -2,6 +2,7 @@
 Core configuration module.
 """
 from app.core.config import settings
+from app.core.openai_client import get_openai_client
 
-__all__ = ["settings"]
+__all__ = ["settings", "get_openai_client"]
 
@@ -0,0 +1,26 @@
+"""
+Shared OpenAI client
+"""
+from app.core.config import settings
+
+_openai_client = None
+
+
+def get_openai_client():
+    """
+    Async OpenAI client shared by chat and embeddings.
+    
+    One client means one HTTP connection pool, so keep-alive connections to
+    the API are reused across requests and services.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        import httpx
+        _openai_client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=50)
+            )
+        )
+    return _openai_client
@@ -14,6 +14,37 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Idempotent DDL for databases created before a schema change
+SCHEMA_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_conv_created ON messages (conversation_id, created_at DESC)",
+    # Server-side timestamps are UTC like the application's datetime.utcnow ones
+    "ALTER TABLE messages ALTER COLUMN created_at SET DEFAULT timezone('utc', now())",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP",
+    "UPDATE documents SET updated_at = upload_date WHERE updated_at IS NULL",
+    # Trigram index so conversation titles can be searched with ILIKE / similarity()
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS conv_title_trgm ON conversations USING gin (title gin_trgm_ops)",
+    # Media rows store their served file name instead of deriving it per request
+    "ALTER TABLE document_images ADD COLUMN IF NOT EXISTS file_name VARCHAR",
+    "ALTER TABLE document_tables ADD COLUMN IF NOT EXISTS file_name VARCHAR",
+    "UPDATE document_images SET file_name = regexp_replace(file_path, '^.*/', '') WHERE file_name IS NULL",
+    "UPDATE document_tables SET file_name = regexp_replace(image_path, '^.*/', '') WHERE file_name IS NULL",
+    # Embeddings are stored as fp16 halfvec; convert fp32 columns once, rebuilding the ANN index
+    """
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'document_chunks'::regclass AND attname = 'embedding') LIKE 'vector%' THEN
+            DROP INDEX IF EXISTS document_chunks_embedding_hnsw;
+            ALTER TABLE document_chunks ALTER COLUMN embedding TYPE halfvec(1536) USING embedding::halfvec(1536);
+        END IF;
+    END $$
+    """,
+    # ANN index for similarity search, plus the per-document filter
+    "CREATE INDEX IF NOT EXISTS document_chunks_embedding_hnsw ON document_chunks USING hnsw (embedding halfvec_cosine_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_document_chunks_document_id ON document_chunks (document_id)",
+]
+
 # Enable pgvector extension before creating tables
 def init_db():
     """Initialize database with pgvector extension and tables."""
@@ -29,8 +60,19 @@ def init_db():
     # Create database tables
     document.Base.metadata.create_all(bind=engine)
     conversation.Base.metadata.create_all(bind=engine)
+    
+    # create_all skips tables that already exist, so bring older schemas up to date
+    with engine.connect() as conn:
+        for statement in SCHEMA_UPGRADES:
+            try:
+                conn.execute(text(statement))
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"Schema upgrade skipped ({statement}): {e}")
+                conn.rollback()
 
-init_db()
+if not settings.SKIP_CREATE_ALL:
+    init_db()
 
 app = FastAPI(
     title="Multimodal Document Chat System",
@@ -1,23 +1,52 @@
 """
 Conversation and message models for chat functionality
 """
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Text, Index
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.sql.expression import FunctionElement
 from datetime import datetime
 from app.db.session import Base
 
+TITLE_MAX_LENGTH = 50
+
+
+class utcnow(FunctionElement):
+    """Database-side current UTC time, naive like the datetime.utcnow defaults."""
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow, "postgresql")
+def _pg_utcnow(element, compiler, **kw):
+    # now() is timestamptz; casting it into a naive column would use the session time zone
+    return "timezone('utc', now())"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
 
 class Conversation(Base):
     __tablename__ = "conversations"
     
     id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, nullable=True)
+    title = Column(String(TITLE_MAX_LENGTH), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     document_id = Column(Integer, ForeignKey("documents.id", ondelete="SET NULL"), nullable=True)
     
     # Relationships
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    messages = relationship(
+        "Message",
+        back_populates="conversation",
+        cascade="all, delete-orphan",
+        order_by="Message.created_at"
+    )
+    
+    @validates("title")
+    def _truncate_title(self, key, value):
+        return value[:TITLE_MAX_LENGTH] if value else value
 
 
 class Message(Base):
@@ -28,7 +57,11 @@ class Message(Base):
     role = Column(String, nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     sources = Column(JSON, nullable=True)  # Sources used for answer (text, images, tables)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=utcnow())
     
     # Relationships
     conversation = relationship("Conversation", back_populates="messages")
+    
+    __table_args__ = (
+        Index("ix_messages_conv_created", conversation_id, created_at.desc()),
+    )
@@ -1,11 +1,32 @@
 """
 Document-related database models
 """
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Text
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Text, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.db.session import Base
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC
+import os
+
+
+class HalfVec(HALFVEC):
+    """HALFVEC that also binds preformatted '[...]' text literals unchanged."""
+    
+    cache_ok = True
+    
+    def bind_processor(self, dialect):
+        process = super().bind_processor(dialect)
+        
+        def bind(value):
+            return value if isinstance(value, str) else process(value)
+        return bind
+
+
+def _basename_of(column: str):
+    """Column default deriving the stored file name from a path column."""
+    def default(context):
+        return os.path.basename(context.get_current_parameters()[column])
+    return default
 
 
 class Document(Base):
@@ -15,6 +36,7 @@ class Document(Base):
     filename = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
     upload_date = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     processing_status = Column(String, default="pending")  # pending, processing, completed, error
     error_message = Column(Text, nullable=True)
     total_pages = Column(Integer, default=0)
@@ -32,9 +54,9 @@ class DocumentChunk(Base):
     __tablename__ = "document_chunks"
     
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False, index=True)
     content = Column(Text, nullable=False)
-    embedding = Column(Vector(1536))  # OpenAI embedding dimension
+    embedding = Column(HalfVec(1536))  # OpenAI embedding dimension, stored as fp16
     page_number = Column(Integer)
     chunk_index = Column(Integer)
     chunk_metadata = Column("metadata", JSON)  # {related_images: [...], related_tables: [...], ...}
@@ -42,6 +64,17 @@ class DocumentChunk(Base):
     
     # Relationships
     document = relationship("Document", back_populates="chunks")
+    
+    __table_args__ = (
+        # Approximate nearest-neighbour index for cosine-distance search across all
+        # documents; per-document searches rank exactly instead (see similarity_search)
+        Index(
+            "document_chunks_embedding_hnsw",
+            embedding,
+            postgresql_using="hnsw",
+            postgresql_ops={"embedding": "halfvec_cosine_ops"}
+        ),
+    )
 
 
 class DocumentImage(Base):
@@ -50,6 +83,7 @@ class DocumentImage(Base):
     id = Column(Integer, primary_key=True, index=True)
     document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
     file_path = Column(String, nullable=False)
+    file_name = Column(String, default=_basename_of("file_path"))  # Served under /uploads/images/
     page_number = Column(Integer)
     caption = Column(Text, nullable=True)
     width = Column(Integer)
@@ -67,6 +101,7 @@ class DocumentTable(Base):
     id = Column(Integer, primary_key=True, index=True)
     document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
     image_path = Column(String, nullable=False)  # Rendered table as image
+    file_name = Column(String, default=_basename_of("image_path"))  # Served under /uploads/tables/
     data = Column(JSON, nullable=True)  # Structured table data
     page_number = Column(Integer)
     caption = Column(Text, nullable=True)
@@ -4,6 +4,7 @@ Services module for document processing, vector storage, and chat.
 from app.services.document_processor import DocumentProcessor
 from app.services.vector_store import VectorStore
 from app.services.chat_engine import ChatEngine
+from app.services.semantic_cache import SemanticCache
 
-__all__ = ["DocumentProcessor", "VectorStore", "ChatEngine"]
+__all__ = ["DocumentProcessor", "VectorStore", "ChatEngine", "SemanticCache"]
 
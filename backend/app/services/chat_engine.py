@@ -1,18 +1,30 @@
 """
 Chat engine service for multimodal RAG.
 """
-from typing import Dict, Any, List, Optional
+from typing import AsyncIterator, Dict, Any, List, Optional
 from sqlalchemy.orm import Session
 from app.models.conversation import Conversation, Message
 from app.models.document import Document, DocumentImage, DocumentTable
 from app.services.vector_store import VectorStore
+from app.services.semantic_cache import semantic_cache
 from app.core.config import settings
+from app.core.openai_client import get_openai_client
 import time
 import logging
-import os
+import re
 
 logger = logging.getLogger(__name__)
 
+# Substring match, so plurals and inflections ("tables", "showing") also count
+IMAGE_INTENT_RE = re.compile(
+    r"image|figure|diagram|picture|show|visual|architecture|illustration|graph|chart|plot"
+)
+TABLE_INTENT_RE = re.compile(
+    r"table|results|data|numbers|comparison|statistics|metrics|performance|benchmark"
+)
+
+FALLBACK_ANSWER = "I apologize, but I encountered an error while processing your question. Please try again."
+
 
 class ChatEngine:
     """
@@ -22,19 +34,14 @@ class ChatEngine:
     def __init__(self, db: Session):
         self.db = db
         self.vector_store = VectorStore(db)
+        self.semantic_cache = semantic_cache
         self._client = None
     
     @property
     def client(self):
         """Lazy initialization of OpenAI client."""
         if self._client is None:
-            from openai import OpenAI
-            import httpx
-            http_client = httpx.Client()
-            self._client = OpenAI(
-                api_key=settings.OPENAI_API_KEY,
-                http_client=http_client
-            )
+            self._client = get_openai_client()
         return self._client
     
     async def process_message(
@@ -49,70 +56,166 @@ class ChatEngine:
         start_time = time.time()
         
         try:
-            history = await self._load_conversation_history(conversation_id)
-            
-            context = await self._search_context(message, document_id, k=settings.TOP_K_RESULTS)
-            
-            media = await self._find_related_media(context, document_id, message)
+            turn = await self.prepare_turn(conversation_id, message, document_id)
             
-            answer = await self._generate_response(message, context, history, media)
-            
-            sources = self._format_sources(context, media)
+            if turn["cached"]:
+                answer = turn["cached"]["answer"]
+            else:
+                answer = await self._generate_response(
+                    message, turn["context"], turn["history"], turn["media"]
+                )
+                if turn["cacheable"]:
+                    await self.semantic_cache.set_answer(
+                        document_id, turn["query_embedding"], answer, turn["sources"]
+                    )
             
             processing_time = time.time() - start_time
             
             return {
                 "answer": answer,
-                "sources": sources,
+                "sources": turn["sources"],
                 "processing_time": round(processing_time, 2)
             }
             
         except Exception as e:
             logger.error(f"Error processing message: {str(e)}")
             return {
-                "answer": f"I apologize, but I encountered an error while processing your question. Please try again.",
+                "answer": FALLBACK_ANSWER,
                 "sources": [],
                 "processing_time": time.time() - start_time
             }
     
+    async def prepare_turn(
+        self,
+        conversation_id: int,
+        message: str,
+        document_id: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Gather everything needed to answer a message; the only step touching the database.
+        """
+        query_embedding = await self.vector_store.embed_query(message)
+        history = self._prior_history(
+            await self._load_conversation_history(conversation_id), message
+        )
+        
+        # Cached answers are keyed on the question alone, so follow-ups that
+        # depend on earlier turns neither read nor populate the answer cache
+        cacheable = not history
+        if cacheable:
+            cached = await self.semantic_cache.get_answer(document_id, query_embedding)
+            if cached:
+                return {
+                    "query_embedding": query_embedding,
+                    "cached": cached,
+                    "cacheable": True,
+                    "sources": cached.get("sources", [])
+                }
+        
+        context = await self._search_context(
+            message,
+            document_id,
+            k=settings.TOP_K_RESULTS,
+            query_embedding=query_embedding
+        )
+        
+        media = await self._find_related_media(context, document_id, message)
+        
+        return {
+            "query_embedding": query_embedding,
+            "cached": None,
+            "cacheable": cacheable,
+            "history": history,
+            "context": context,
+            "media": media,
+            "sources": self._format_sources(context, media)
+        }
+    
+    async def stream_answer(
+        self,
+        message: str,
+        document_id: Optional[int],
+        turn: Dict[str, Any]
+    ) -> AsyncIterator[str]:
+        """
+        Stream answer text for a prepared turn as it is generated.
+        """
+        if turn["cached"]:
+            yield turn["cached"]["answer"]
+            return
+        
+        messages = self._build_messages(message, turn["context"], turn["history"], turn["media"])
+        
+        stream = await self.client.chat.completions.create(
+            model=settings.OPENAI_MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1000,
+            stream=True
+        )
+        
+        parts = []
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        
+        if turn["cacheable"]:
+            await self.semantic_cache.set_answer(
+                document_id, turn["query_embedding"], "".join(parts), turn["sources"]
+            )
+    
     async def _load_conversation_history(
         self,
         conversation_id: int,
-        limit: int = 5
+        limit: int = settings.CHAT_HISTORY_TURNS
     ) -> List[Dict[str, str]]:
         """
         Load recent conversation history.
         """
-        messages = self.db.query(Message).filter(
+        recent = self.db.query(
+            Message.id, Message.role, Message.content, Message.created_at
+        ).filter(
             Message.conversation_id == conversation_id
-        ).order_by(Message.created_at.desc()).limit(limit * 2).all()
-        
-        messages = list(reversed(messages))
+        ).order_by(
+            Message.created_at.desc(), Message.id.desc()
+        ).limit(limit * 2).subquery()
         
-        history = []
-        for msg in messages:
-            history.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        messages = self.db.query(recent.c.role, recent.c.content).order_by(
+            recent.c.created_at.asc(), recent.c.id.asc()
+        ).all()
         
-        return history
+        return [{"role": msg.role, "content": msg.content} for msg in messages]
     
     async def _search_context(
         self,
         query: str,
         document_id: Optional[int] = None,
-        k: int = 5
+        k: int = 5,
+        query_embedding: Optional[List[float]] = None
     ) -> List[Dict[str, Any]]:
         """
         Search for relevant context using vector store.
         """
         try:
+            if query_embedding is None:
+                query_embedding = await self.vector_store.embed_query(query)
+            
+            cached = await self.semantic_cache.get_context(document_id, query_embedding, k)
+            if cached is not None:
+                return cached
+            
             results = await self.vector_store.similarity_search(
                 query=query,
                 document_id=document_id,
-                k=k
+                k=k,
+                query_embedding=query_embedding
             )
+            # Trim once here; prompt building and source previews reuse the bounded text
+            for chunk in results:
+                chunk["content"] = chunk["content"][:500]
+            await self.semantic_cache.set_context(document_id, query_embedding, k, results)
             return results
         except Exception as e:
             logger.error(f"Error searching context: {str(e)}")
@@ -144,25 +247,23 @@ class ChatEngine:
                     seen_table_ids.add(tbl.get("id"))
         
         query_lower = query.lower()
-        wants_image = any(word in query_lower for word in [
-            'image', 'figure', 'diagram', 'picture', 'show', 'visual',
-            'architecture', 'illustration', 'graph', 'chart', 'plot'
-        ])
-        wants_table = any(word in query_lower for word in [
-            'table', 'results', 'data', 'numbers', 'comparison',
-            'statistics', 'metrics', 'performance', 'benchmark'
-        ])
-        
-        if document_id and (wants_image or not images):
+        wants_image = IMAGE_INTENT_RE.search(query_lower) is not None
+        wants_table = TABLE_INTENT_RE.search(query_lower) is not None
+        
+        image_limit = 3 if wants_image else 2
+        table_limit = 2 if wants_table else 1
+        
+        if document_id and (wants_image or not images) and len(images) < image_limit:
             db_images = self.db.query(DocumentImage).filter(
-                DocumentImage.document_id == document_id
-            ).limit(5).all()
+                DocumentImage.document_id == document_id,
+                DocumentImage.id.notin_(seen_image_ids)
+            ).limit(image_limit - len(images)).all()
             
             for img in db_images:
                 if img.id not in seen_image_ids:
                     images.append({
                         "id": img.id,
-                        "url": f"/uploads/images/{os.path.basename(img.file_path)}",
+                        "url": f"/uploads/images/{img.file_name}",
                         "caption": img.caption,
                         "page": img.page_number,
                         "width": img.width,
@@ -170,16 +271,17 @@ class ChatEngine:
                     })
                     seen_image_ids.add(img.id)
         
-        if document_id and (wants_table or not tables):
+        if document_id and (wants_table or not tables) and len(tables) < table_limit:
             db_tables = self.db.query(DocumentTable).filter(
-                DocumentTable.document_id == document_id
-            ).limit(3).all()
+                DocumentTable.document_id == document_id,
+                DocumentTable.id.notin_(seen_table_ids)
+            ).limit(table_limit - len(tables)).all()
             
             for tbl in db_tables:
                 if tbl.id not in seen_table_ids:
                     tables.append({
                         "id": tbl.id,
-                        "url": f"/uploads/tables/{os.path.basename(tbl.image_path)}",
+                        "url": f"/uploads/tables/{tbl.file_name}",
                         "caption": tbl.caption,
                         "page": tbl.page_number,
                         "rows": tbl.rows,
@@ -188,17 +290,7 @@ class ChatEngine:
                     })
                     seen_table_ids.add(tbl.id)
         
-        if wants_image:
-            images = images[:3]
-        else:
-            images = images[:2]
-        
-        if wants_table:
-            tables = tables[:2]
-        else:
-            tables = tables[:1]
-        
-        return {"images": images, "tables": tables}
+        return {"images": images[:image_limit], "tables": tables[:table_limit]}
     
     async def _generate_response(
         self,
@@ -210,22 +302,10 @@ class ChatEngine:
         """
         Generate response using LLM.
         """
-        system_prompt = self._build_system_prompt(media)
-        context_text = self._build_context_text(context)
-        user_prompt = self._build_user_prompt(message, context_text, media)
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        for hist_msg in history[-6:]:
-            messages.append({
-                "role": hist_msg["role"],
-                "content": hist_msg["content"][:1000]
-            })
-        
-        messages.append({"role": "user", "content": user_prompt})
+        messages = self._build_messages(message, context, history, media)
         
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=settings.OPENAI_MODEL,
                 messages=messages,
                 temperature=0.7,
@@ -238,6 +318,40 @@ class ChatEngine:
             logger.error(f"Error generating response: {str(e)}")
             raise
     
+    @staticmethod
+    def _prior_history(
+        history: List[Dict[str, str]],
+        message: str
+    ) -> List[Dict[str, str]]:
+        """Drop the current question, which is already stored and is sent inside the user prompt."""
+        if history and history[-1]["role"] == "user" and history[-1]["content"] == message:
+            return history[:-1]
+        return history
+    
+    def _build_messages(
+        self,
+        message: str,
+        context: List[Dict[str, Any]],
+        history: List[Dict[str, str]],
+        media: Dict[str, List[Dict[str, Any]]]
+    ) -> List[Dict[str, str]]:
+        """Build the chat completion message list."""
+        system_prompt = self._build_system_prompt(media)
+        context_text = self._build_context_text(context)
+        user_prompt = self._build_user_prompt(message, context_text, media)
+        
+        messages = [{"role": "system", "content": system_prompt}]
+        
+        for hist_msg in self._prior_history(history, message):
+            messages.append({
+                "role": hist_msg["role"],
+                "content": hist_msg["content"][:settings.CHAT_HISTORY_MAX_CHARS]
+            })
+        
+        messages.append({"role": "user", "content": user_prompt})
+        
+        return messages
+    
     def _build_system_prompt(self, media: Dict[str, List[Dict[str, Any]]]) -> str:
         """Build system prompt for the LLM."""
         prompt = """You are a helpful document assistant that answers questions based on the provided document context. 
@@ -267,7 +381,7 @@ Key guidelines:
         for i, chunk in enumerate(context, 1):
             page = chunk.get("page_number", "?")
             score = chunk.get("score", 0)
-            content = chunk.get("content", "")[:500]
+            content = chunk.get("content", "")
             context_parts.append(f"[Source {i}, Page {page}, Relevance: {score:.2f}]\n{content}")
         
         return "\n\n".join(context_parts)
@@ -1,23 +1,145 @@
 """
 Document processing service using Docling
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
+from xml.sax.saxutils import escape
 from sqlalchemy.orm import Session
 from app.models.document import Document, DocumentChunk, DocumentImage, DocumentTable
 from app.services.vector_store import VectorStore
 from app.core.config import settings
+import asyncio
+import multiprocessing
 import os
+import threading
 import time
 import uuid
 import json
 import logging
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 import io
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 logger = logging.getLogger(__name__)
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TOKEN_ENCODING = "cl100k_base"  # Used by text-embedding-3-*
+
+_converter = None
+_image_pool: Optional[ProcessPoolExecutor] = None
+_converter_lock = threading.Lock()
+
+
+def _get_converter():
+    """Shared Docling converter so pipeline models are loaded once per process."""
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                from docling.document_converter import DocumentConverter, PdfFormatOption
+                from docling.datamodel.base_models import InputFormat
+                from docling.datamodel.pipeline_options import PdfPipelineOptions
+                
+                pipeline_options = PdfPipelineOptions()
+                pipeline_options.do_ocr = False
+                pipeline_options.do_table_structure = True
+                pipeline_options.generate_page_images = True
+                pipeline_options.generate_picture_images = True
+                
+                _converter = DocumentConverter(
+                    format_options={
+                        InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+                    }
+                )
+    return _converter
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Tokenizer used by the embedding model, loaded once per process."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load {TOKEN_ENCODING} encoding, estimating tokens from length: {e}")
+        return None
+
+
+def _token_length(text: str) -> int:
+    """Length of text in embedding-model tokens."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode_ordinary(text))
+
+
+@lru_cache(maxsize=4)
+def _get_text_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    """Token-based text splitter, shared by every processor with the same settings."""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=_token_length,
+        separators=["\n\n", "\n", ". ", " ", ""]
+    )
+
+
+@lru_cache(maxsize=2)
+def _get_font(bold: bool):
+    """Table font, parsed once per process."""
+    name = "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf"
+    try:
+        return ImageFont.truetype(f"/usr/share/fonts/truetype/dejavu/{name}", 11)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _get_image_pool() -> ProcessPoolExecutor:
+    """Worker processes for PIL encoding and drawing, created on first use."""
+    global _image_pool
+    if _image_pool is None:
+        # Forking a process that holds DB connections, the Redis/OpenAI clients and
+        # loaded Docling models duplicates their sockets and locks into the workers
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _image_pool = ProcessPoolExecutor(
+            max_workers=settings.IMAGE_WORKERS or None,
+            mp_context=multiprocessing.get_context(method)
+        )
+    return _image_pool
+
+
+def _encode_png(image_data: Union[bytes, Image.Image], file_path: str):
+    """Encode an image to an RGB PNG file (runs in the image pool)."""
+    img = image_data if isinstance(image_data, Image.Image) else Image.open(io.BytesIO(image_data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.save(file_path, 'PNG')
+
+
+def _render_table_png(table_data: Any, title: str, file_path: str):
+    """Render a table to a PNG file (runs in the image pool)."""
+    DocumentProcessor._render_table_as_image(table_data, title).save(file_path, 'PNG')
+
+
+def _page_of(item: Any, default: int) -> int:
+    """Page number of a Docling item from its provenance, if recorded."""
+    prov = getattr(item, 'prov', None)
+    if prov:
+        return getattr(prov[0], 'page_no', None) or default
+    return getattr(item, 'page_no', None) or default
+
+
+def _item_text(item: Any, doc: Any) -> Optional[str]:
+    """Text of a Docling item; tables carry none, so their caption and cells are exported as markdown."""
+    if getattr(item, 'label', None) == 'table' and hasattr(item, 'export_to_markdown'):
+        parts = [item.caption_text(doc)] if hasattr(item, 'caption_text') else []
+        parts.append(item.export_to_markdown(doc=doc))
+        return "\n\n".join(part for part in parts if part and part.strip())
+    return getattr(item, 'text', None)
+
 
 class DocumentProcessor:
     """
@@ -27,13 +149,10 @@ class DocumentProcessor:
     def __init__(self, db: Session):
         self.db = db
         self.vector_store = VectorStore(db)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=settings.CHUNK_SIZE,
-            chunk_overlap=settings.CHUNK_OVERLAP,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
+        self.text_splitter = _get_text_splitter(settings.CHUNK_SIZE, settings.CHUNK_OVERLAP)
         self.upload_dir = settings.UPLOAD_DIR
+        # Image and table files written for the current ingest, removed if it rolls back
+        self._written_files: List[str] = []
         os.makedirs(f"{self.upload_dir}/images", exist_ok=True)
         os.makedirs(f"{self.upload_dir}/tables", exist_ok=True)
     
@@ -42,28 +161,14 @@ class DocumentProcessor:
         Process a PDF document using Docling.
         """
         start_time = time.time()
+        self._written_files = []
         
         try:
             await self._update_document_status(document_id, "processing")
             
-            from docling.document_converter import DocumentConverter
-            from docling.datamodel.base_models import InputFormat
-            from docling.datamodel.pipeline_options import PdfPipelineOptions
-            from docling.document_converter import PdfFormatOption
-            
-            pipeline_options = PdfPipelineOptions()
-            pipeline_options.do_ocr = False
-            pipeline_options.do_table_structure = True
-            pipeline_options.generate_page_images = True
-            pipeline_options.generate_picture_images = True
-            
-            converter = DocumentConverter(
-                format_options={
-                    InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-                }
-            )
-            
-            result = converter.convert(file_path)
+            # Model loading, conversion and export are CPU-bound; keep them off the event loop
+            converter = await asyncio.to_thread(_get_converter)
+            result = await asyncio.to_thread(converter.convert, file_path)
             doc = result.document
             
             total_pages = len(doc.pages) if hasattr(doc, 'pages') else 0
@@ -71,11 +176,16 @@ class DocumentProcessor:
             page_images: Dict[int, List[int]] = {}
             page_tables: Dict[int, List[int]] = {}
             
-            images_saved = await self._extract_and_save_images(doc, document_id, page_images)
-            tables_saved = await self._extract_and_save_tables(doc, document_id, page_tables)
+            # Rows are only flushed from here on and committed once with the final status.
+            # Images and tables overlap their pool work; session calls between awaits stay synchronous.
+            images_saved, tables_saved = await asyncio.gather(
+                self._extract_and_save_images(doc, document_id, page_images),
+                self._extract_and_save_tables(doc, document_id, page_tables)
+            )
             
-            text_content = doc.export_to_markdown()
-            chunks = self._chunk_text(text_content, document_id, page_images, page_tables)
+            chunks = await asyncio.to_thread(
+                self._chunk_document, doc, document_id, page_images, page_tables
+            )
             
             chunks_stored = await self._save_text_chunks(chunks, document_id)
             
@@ -101,6 +211,8 @@ class DocumentProcessor:
             
         except Exception as e:
             logger.error(f"Error processing document {document_id}: {str(e)}")
+            self.db.rollback()
+            self._remove_written_files()
             await self._update_document_status(document_id, "error", str(e))
             return {
                 "status": "error",
@@ -108,6 +220,59 @@ class DocumentProcessor:
                 "processing_time": time.time() - start_time
             }
     
+    def _remove_written_files(self):
+        """Delete files whose rows were rolled back, so a failed ingest leaves none behind."""
+        for path in self._written_files:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove {path}: {str(e)}")
+        self._written_files = []
+    
+    def _chunk_document(
+        self,
+        doc: Any,
+        document_id: int,
+        page_images: Dict[int, List[int]],
+        page_tables: Dict[int, List[int]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Split document text into chunks page by page, tagged with the exact page.
+        
+        Tables are kept in reading order as markdown so their contents are embedded too.
+        Falls back to the markdown export when the document exposes no text items.
+        """
+        pages: Dict[int, List[str]] = {}
+        if hasattr(doc, 'iterate_items'):
+            for item, _level in doc.iterate_items():
+                text = _item_text(item, doc)
+                if text and text.strip():
+                    pages.setdefault(_page_of(item, 1), []).append(text)
+        
+        if not pages:
+            return self._chunk_text(doc.export_to_markdown(), document_id, page_images, page_tables)
+        
+        chunks = []
+        for page_num in sorted(pages):
+            for chunk_content in self.text_splitter.split_text("\n\n".join(pages[page_num])):
+                if not chunk_content.strip():
+                    continue
+                
+                chunks.append({
+                    "content": chunk_content,
+                    "page_number": page_num,
+                    "chunk_index": len(chunks),
+                    "metadata": {
+                        "related_images": page_images.get(page_num, [])[:3],
+                        "related_tables": page_tables.get(page_num, [])[:2],
+                        "char_count": len(chunk_content)
+                    }
+                })
+        
+        return chunks
+    
     def _chunk_text(
         self, 
         text: str, 
@@ -123,29 +288,26 @@ class DocumentProcessor:
         
         raw_chunks = self.text_splitter.split_text(text)
         
+        # Index media by page once; slot 0 stays empty so page - 1 never wraps
+        max_page = max(page_images.keys(), default=1)
+        images_by_page = [()] + [page_images.get(p, ()) for p in range(1, max_page + 2)]
+        tables_by_page = [()] + [page_tables.get(p, ()) for p in range(1, max_page + 2)]
+        
         chunks = []
         for idx, chunk_content in enumerate(raw_chunks):
             if not chunk_content.strip():
                 continue
             
-            estimated_page = min(idx // 3 + 1, max(page_images.keys()) if page_images else 1)
-            
-            related_images = []
-            related_tables = []
-            
-            for page in range(max(1, estimated_page - 1), estimated_page + 2):
-                if page in page_images:
-                    related_images.extend(page_images[page])
-                if page in page_tables:
-                    related_tables.extend(page_tables[page])
+            estimated_page = min(idx // 3 + 1, max_page)
+            window = slice(estimated_page - 1, estimated_page + 2)
             
             chunks.append({
                 "content": chunk_content,
                 "page_number": estimated_page,
                 "chunk_index": idx,
                 "metadata": {
-                    "related_images": related_images[:3],
-                    "related_tables": related_tables[:2],
+                    "related_images": list(islice(chain.from_iterable(images_by_page[window]), 3)),
+                    "related_tables": list(islice(chain.from_iterable(tables_by_page[window]), 2)),
                     "char_count": len(chunk_content)
                 }
             })
@@ -155,24 +317,12 @@ class DocumentProcessor:
     async def _save_text_chunks(self, chunks: List[Dict[str, Any]], document_id: int) -> int:
         """
         Save text chunks to database with embeddings.
-        """
-        stored_count = 0
         
-        for chunk in chunks:
-            try:
-                await self.vector_store.store_chunk(
-                    content=chunk["content"],
-                    document_id=document_id,
-                    page_number=chunk["page_number"],
-                    chunk_index=chunk["chunk_index"],
-                    metadata=chunk["metadata"]
-                )
-                stored_count += 1
-            except Exception as e:
-                logger.error(f"Error storing chunk {chunk['chunk_index']}: {str(e)}")
-                continue
-        
-        return stored_count
+        Errors propagate, so a document without searchable text ends up
+        marked as failed instead of completed.
+        """
+        with self.db.begin_nested():
+            return await self.vector_store.store_chunks_bulk(chunks, document_id)
     
     async def _extract_and_save_images(
         self,
@@ -189,15 +339,12 @@ class DocumentProcessor:
             if hasattr(doc, 'pictures') and doc.pictures:
                 for idx, picture in enumerate(doc.pictures):
                     try:
-                        page_num = getattr(picture, 'page_no', idx + 1) or (idx + 1)
+                        page_num = _page_of(picture, idx + 1)
                         
                         image_data = None
                         if hasattr(picture, 'image') and picture.image:
                             if hasattr(picture.image, 'pil_image'):
-                                pil_img = picture.image.pil_image
-                                img_buffer = io.BytesIO()
-                                pil_img.save(img_buffer, format='PNG')
-                                image_data = img_buffer.getvalue()
+                                image_data = picture.image.pil_image
                             elif isinstance(picture.image, bytes):
                                 image_data = picture.image
                         
@@ -229,13 +376,8 @@ class DocumentProcessor:
                     if hasattr(page, 'image') and page.image:
                         try:
                             if hasattr(page.image, 'pil_image'):
-                                pil_img = page.image.pil_image
-                                img_buffer = io.BytesIO()
-                                pil_img.save(img_buffer, format='PNG')
-                                image_data = img_buffer.getvalue()
-                                
                                 doc_image = await self._save_image(
-                                    image_data=image_data,
+                                    image_data=page.image.pil_image,
                                     document_id=document_id,
                                     page_number=page_num,
                                     metadata={
@@ -272,7 +414,7 @@ class DocumentProcessor:
             if hasattr(doc, 'tables') and doc.tables:
                 for idx, table in enumerate(doc.tables):
                     try:
-                        page_num = getattr(table, 'page_no', idx + 1) or (idx + 1)
+                        page_num = _page_of(table, idx + 1)
                         
                         table_data = None
                         if hasattr(table, 'export_to_dataframe'):
@@ -310,31 +452,42 @@ class DocumentProcessor:
     
     async def _save_image(
         self, 
-        image_data: bytes, 
+        image_data: Union[bytes, Image.Image], 
         document_id: int, 
         page_number: int,
         metadata: Dict[str, Any]
     ) -> Optional[DocumentImage]:
         """
         Save an extracted image to filesystem and database.
+        
+        Accepts encoded bytes or a decoded PIL image; either is encoded at most once.
         """
         try:
             image_id = str(uuid.uuid4())
             filename = f"{document_id}_{image_id}.png"
             file_path = os.path.join(self.upload_dir, "images", filename)
             
-            img = Image.open(io.BytesIO(image_data))
+            if isinstance(image_data, Image.Image):
+                img = image_data
+            else:
+                img = Image.open(io.BytesIO(image_data))
             width, height = img.size
             
-            if img.mode in ('RGBA', 'LA', 'P'):
-                img = img.convert('RGB')
-            img.save(file_path, 'PNG', optimize=True)
+            if isinstance(image_data, bytes) and image_data[:8] == PNG_SIGNATURE and img.mode == 'RGB':
+                with open(file_path, 'wb') as f:
+                    f.write(image_data)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    _get_image_pool(), _encode_png, image_data, file_path
+                )
+            self._written_files.append(file_path)
             
             caption = metadata.get("caption", f"Image from page {page_number}")
             
             doc_image = DocumentImage(
                 document_id=document_id,
                 file_path=file_path,
+                file_name=filename,
                 page_number=page_number,
                 caption=caption,
                 width=width,
@@ -342,15 +495,14 @@ class DocumentProcessor:
                 image_metadata=metadata
             )
             
-            self.db.add(doc_image)
-            self.db.commit()
-            self.db.refresh(doc_image)
+            # Savepoint so a failed row doesn't abort the document's transaction
+            with self.db.begin_nested():
+                self.db.add(doc_image)
             
             return doc_image
             
         except Exception as e:
             logger.error(f"Error saving image: {str(e)}")
-            self.db.rollback()
             return None
     
     async def _save_table(
@@ -365,11 +517,19 @@ class DocumentProcessor:
         """
         try:
             table_id = str(uuid.uuid4())
-            filename = f"{document_id}_{table_id}.png"
-            file_path = os.path.join(self.upload_dir, "tables", filename)
-            
-            table_image = self._render_table_as_image(table_data, metadata.get("caption", "Table"))
-            table_image.save(file_path, 'PNG')
+            title = metadata.get("caption", "Table")
+            if settings.TABLE_IMAGE_FORMAT == "svg":
+                filename = f"{document_id}_{table_id}.svg"
+                file_path = os.path.join(self.upload_dir, "tables", filename)
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(self._render_table_as_svg(table_data, title))
+            else:
+                filename = f"{document_id}_{table_id}.png"
+                file_path = os.path.join(self.upload_dir, "tables", filename)
+                await asyncio.get_running_loop().run_in_executor(
+                    _get_image_pool(), _render_table_png, table_data, title, file_path
+                )
+            self._written_files.append(file_path)
             
             rows = 0
             columns = 0
@@ -383,6 +543,7 @@ class DocumentProcessor:
             doc_table = DocumentTable(
                 document_id=document_id,
                 image_path=file_path,
+                file_name=filename,
                 data=table_data,
                 page_number=page_number,
                 caption=caption,
@@ -391,23 +552,92 @@ class DocumentProcessor:
                 table_metadata=metadata
             )
             
-            self.db.add(doc_table)
-            self.db.commit()
-            self.db.refresh(doc_table)
+            with self.db.begin_nested():
+                self.db.add(doc_table)
             
             return doc_table
             
         except Exception as e:
             logger.error(f"Error saving table: {str(e)}")
-            self.db.rollback()
             return None
     
-    def _render_table_as_image(self, table_data: Any, title: str = "Table") -> Image.Image:
+    @staticmethod
+    def _table_rows(table_data: List[Any]) -> Tuple[List[str], List[List[str]]]:
         """
-        Render table data as an image using PIL.
+        Split table data into header labels and stringified rows.
+        """
+        if isinstance(table_data[0], dict):
+            headers = list(table_data[0].keys())
+            rows_data = [[str(row.get(h, '')) for h in headers] for row in table_data]
+        else:
+            headers = [f"Col {i+1}" for i in range(len(table_data[0]) if table_data else 0)]
+            rows_data = [[str(cell) for cell in row] for row in table_data]
+        return headers, rows_data
+    
+    @staticmethod
+    def _render_table_as_svg(table_data: Any, title: str = "Table") -> str:
         """
-        from PIL import ImageDraw, ImageFont
+        Render table data as an SVG document, using the same layout as the PNG renderer.
+        """
+        cell_padding = 10
+        cell_height = 30
+        min_cell_width = 80
+        max_cell_width = 200
+        font = 'font-family="DejaVu Sans, sans-serif" font-size="11"'
         
+        if not table_data or not isinstance(table_data, list):
+            return (
+                '<svg xmlns="http://www.w3.org/2000/svg" width="300" height="100">'
+                '<rect width="100%" height="100%" fill="white"/>'
+                f'<text x="10" y="50" {font}>Empty table</text></svg>'
+            )
+        
+        headers, rows_data = DocumentProcessor._table_rows(table_data)
+        
+        col_widths = []
+        for i, header in enumerate(headers):
+            max_width = max([len(header)] + [len(row[i]) for row in rows_data if i < len(row)])
+            col_widths.append(min(max(min_cell_width, max_width * 8 + cell_padding * 2), max_cell_width))
+        col_x = [1 + sum(col_widths[:i]) for i in range(len(col_widths))]
+        
+        table_width = sum(col_widths) + 2
+        table_height = (len(rows_data) + 1) * cell_height + cell_height + 2
+        
+        parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{table_width}" height="{table_height}">',
+            '<rect width="100%" height="100%" fill="white"/>',
+            f'<text x="10" y="18" {font} font-weight="bold">{escape(title[:50])}</text>',
+            f'<rect x="0" y="{cell_height}" width="{table_width}" height="{cell_height}" fill="#e0e0e0"/>',
+        ]
+        parts.extend(
+            f'<rect x="0" y="{(row_idx + 2) * cell_height}" width="{table_width}" height="{cell_height}" fill="#f5f5f5"/>'
+            for row_idx in range(1, len(rows_data), 2)
+        )
+        parts.extend(
+            f'<text x="{col_x[i] + cell_padding}" y="{cell_height + 19}" {font} font-weight="bold">{escape(header[:15])}</text>'
+            for i, header in enumerate(headers)
+        )
+        parts.extend(
+            f'<line x1="{col_x[i] + col_widths[i]}" y1="{cell_height}" x2="{col_x[i] + col_widths[i]}" y2="{table_height}" stroke="gray"/>'
+            for i in range(len(col_widths))
+        )
+        for row_idx, row in enumerate(rows_data):
+            y = (row_idx + 2) * cell_height
+            parts.append(f'<line x1="0" y1="{y}" x2="{table_width}" y2="{y}" stroke="lightgray"/>')
+            parts.extend(
+                f'<text x="{col_x[col_idx] + cell_padding}" y="{y + 19}" {font}>{escape(cell[:20])}</text>'
+                for col_idx, cell in enumerate(row[:len(col_widths)])
+            )
+        parts.append(f'<rect x="0.5" y="0.5" width="{table_width - 1}" height="{table_height - 1}" fill="none" stroke="gray"/>')
+        parts.append('</svg>')
+        
+        return "".join(parts)
+    
+    @staticmethod
+    def _render_table_as_image(table_data: Any, title: str = "Table") -> Image.Image:
+        """
+        Render table data as an image using PIL.
+        """
         cell_padding = 10
         cell_height = 30
         min_cell_width = 80
@@ -419,12 +649,7 @@ class DocumentProcessor:
             draw.text((10, 40), "Empty table", fill='black')
             return img
         
-        if isinstance(table_data[0], dict):
-            headers = list(table_data[0].keys())
-            rows_data = [[str(row.get(h, '')) for h in headers] for row in table_data]
-        else:
-            headers = [f"Col {i+1}" for i in range(len(table_data[0]) if table_data else 0)]
-            rows_data = [[str(cell) for cell in row] for row in table_data]
+        headers, rows_data = DocumentProcessor._table_rows(table_data)
         
         col_widths = []
         for i, header in enumerate(headers):
@@ -440,12 +665,8 @@ class DocumentProcessor:
         img = Image.new('RGB', (table_width, table_height), color='white')
         draw = ImageDraw.Draw(img)
         
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 11)
-            bold_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 11)
-        except:
-            font = ImageFont.load_default()
-            bold_font = font
+        font = _get_font(bold=False)
+        bold_font = _get_font(bold=True)
         
         draw.text((10, 5), title[:50], fill='black', font=bold_font)
         
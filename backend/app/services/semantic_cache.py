@@ -0,0 +1,210 @@
+"""
+Semantic cache for chat answers and retrieved context using Redis.
+"""
+from typing import List, Dict, Any, Optional
+import numpy as np
+from app.core.config import settings
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# text-embedding-3 models keep most of the signal in the leading dimensions,
+# so these are scanned first and the full embedding only confirms the best match
+SKETCH_DIMENSIONS = 256
+SKETCH_MARGIN = 0.05
+
+
+class SemanticCache:
+    """
+    Cache chat answers keyed by document and query embedding.
+    
+    Answers for a document are stored in three Redis hashes sharing the same
+    entry ids: compact fp16 sketches (the leading dimensions of the query
+    embedding), the full float32 embeddings and the cached answers. A lookup
+    first tries the exact embedding, then scans the sketches, which are small
+    enough to fetch on every request, and confirms the best candidate against
+    its full embedding. Retrieved context is cached separately under the
+    exact embedding hash.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        """Lazy initialization of Redis client."""
+        if self._client is None:
+            from redis.asyncio import Redis
+            self._client = Redis.from_url(
+                settings.REDIS_URL,
+                socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT
+            )
+        return self._client
+
+    @staticmethod
+    def _scope(document_id: Optional[int]) -> str:
+        return str(document_id) if document_id else "all"
+
+    @staticmethod
+    def _to_bytes(embedding: List[float]) -> bytes:
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def _sketch(embedding: np.ndarray) -> np.ndarray:
+        """Unit-length leading dimensions of an embedding."""
+        head = embedding[:SKETCH_DIMENSIONS]
+        return head / (np.linalg.norm(head) + 1e-12)
+
+    def _entry_id(self, embedding: List[float]) -> str:
+        return hashlib.sha1(self._to_bytes(embedding)).hexdigest()
+
+    async def get_answer(
+        self,
+        document_id: Optional[int],
+        query_embedding: List[float]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached answer for the most similar earlier query, if any.
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return None
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if not query_norm:
+            return None
+
+        prefix = f"semantic_cache:{self._scope(document_id)}"
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hget(f"{prefix}:answers", self._entry_id(query_embedding))
+                pipe.hgetall(f"{prefix}:sketches")
+                exact, sketches = await pipe.execute()
+            if exact:
+                return json.loads(exact)
+            if not sketches:
+                return None
+
+            entry_ids = list(sketches.keys())
+            matrix = np.frombuffer(b"".join(sketches.values()), dtype=np.float16)
+            matrix = matrix.reshape(len(entry_ids), -1).astype(np.float32)
+            scores = matrix @ self._sketch(query)
+
+            best = int(np.argmax(scores))
+            if scores[best] < settings.SEMANTIC_CACHE_THRESHOLD - SKETCH_MARGIN:
+                return None
+
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hget(f"{prefix}:embeddings", entry_ids[best])
+                pipe.hget(f"{prefix}:answers", entry_ids[best])
+                stored, cached = await pipe.execute()
+            if not stored or not cached:
+                return None
+
+            candidate = np.frombuffer(stored, dtype=np.float32)
+            score = candidate @ query / (np.linalg.norm(candidate) * query_norm + 1e-12)
+            if score < settings.SEMANTIC_CACHE_THRESHOLD:
+                return None
+            return json.loads(cached)
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+
+    async def set_answer(
+        self,
+        document_id: Optional[int],
+        query_embedding: List[float],
+        answer: str,
+        sources: List[Dict[str, Any]]
+    ):
+        """
+        Store an answer under its query embedding.
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return
+
+        prefix = f"semantic_cache:{self._scope(document_id)}"
+        keys = [f"{prefix}:sketches", f"{prefix}:embeddings", f"{prefix}:answers"]
+        entry_id = self._entry_id(query_embedding)
+        query = np.asarray(query_embedding, dtype=np.float32)
+
+        try:
+            if await self.client.hlen(keys[0]) >= settings.SEMANTIC_CACHE_MAX_ENTRIES:
+                return
+
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hset(keys[0], entry_id, self._sketch(query).astype(np.float16).tobytes())
+                pipe.hset(keys[1], entry_id, query.tobytes())
+                pipe.hset(keys[2], entry_id, json.dumps(
+                    {"answer": answer, "sources": sources}, default=str
+                ))
+                for key in keys:
+                    pipe.expire(key, settings.SEMANTIC_CACHE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+
+    async def invalidate(self, document_id: Optional[int]):
+        """
+        Drop cached answers and context for a document, and for the all-documents scope.
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return
+
+        scopes = {self._scope(document_id), self._scope(None)}
+        try:
+            for scope in scopes:
+                keys = [key async for key in self.client.scan_iter(match=f"semantic_cache:{scope}:*")]
+                if keys:
+                    await self.client.unlink(*keys)
+        except Exception as e:
+            logger.warning(f"Semantic cache invalidation failed: {e}")
+
+    async def get_context(
+        self,
+        document_id: Optional[int],
+        query_embedding: List[float],
+        k: int
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return cached search results for an identical query embedding.
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return None
+
+        key = f"semantic_cache:{self._scope(document_id)}:context:{k}:{self._entry_id(query_embedding)}"
+        try:
+            cached = await self.client.get(key)
+            return json.loads(cached) if cached else None
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+
+    async def set_context(
+        self,
+        document_id: Optional[int],
+        query_embedding: List[float],
+        k: int,
+        context: List[Dict[str, Any]]
+    ):
+        """
+        Store search results under the exact query embedding.
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return
+
+        key = f"semantic_cache:{self._scope(document_id)}:context:{k}:{self._entry_id(query_embedding)}"
+        try:
+            await self.client.set(
+                key,
+                json.dumps(context, default=str),
+                ex=settings.SEMANTIC_CACHE_TTL
+            )
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+
+
+semantic_cache = SemanticCache()
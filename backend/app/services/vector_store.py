@@ -1,16 +1,65 @@
 """
 Vector store service using pgvector.
 """
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence
+from collections import OrderedDict
 import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import and_, bindparam, insert, or_, text
+from pgvector.sqlalchemy import HALFVEC
 from app.models.document import DocumentChunk, DocumentImage, DocumentTable
+from app.services.batcher import AsyncBatcher
 from app.core.config import settings
+from app.core.openai_client import get_openai_client
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared, immutable embedding for empty text
+ZERO_EMBEDDING = (0.0,) * settings.EMBEDDING_DIMENSION
+
+# Query embeddings are bound through pgvector's column type rather than cast from a string in SQL
+QUERY_VECTOR = bindparam("query_embedding", type_=HALFVEC(settings.EMBEDDING_DIMENSION))
+
+
+def _halfvec_literals(embeddings: List[List[float]]) -> List[str]:
+    """
+    Convert embeddings to fp16 once as a matrix and format them as halfvec literals.
+    
+    Five significant digits round-trip fp16 exactly, so the text is about half
+    the size of pgvector's default formatting and several times faster to build.
+    The embedding column type binds these strings as they are.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float16)
+    if not matrix.size:
+        return []
+    dimensions = matrix.shape[1]
+    template = "[" + ",".join(["%.5g"] * dimensions) + "]"
+    return [template % tuple(row) for row in matrix.tolist()]
+
+
+_extension_checked = False
+
+
+async def _embed_queries(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of queries with a single OpenAI request."""
+    response = await get_openai_client().embeddings.create(
+        model=settings.OPENAI_EMBEDDING_MODEL,
+        input=texts
+    )
+    return [item.embedding for item in response.data]
+
+
+# Query text -> embedding, least recently used first
+_query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
+query_embedding_batcher = AsyncBatcher(
+    _embed_queries,
+    max_batch=settings.QUERY_EMBEDDING_BATCH_SIZE,
+    max_wait_ms=settings.QUERY_EMBEDDING_BATCH_WAIT_MS
+)
+
 
 class VectorStore:
     """
@@ -26,17 +75,15 @@ class VectorStore:
     def client(self):
         """Lazy initialization of OpenAI client."""
         if self._client is None:
-            from openai import OpenAI
-            import httpx
-            http_client = httpx.Client()
-            self._client = OpenAI(
-                api_key=settings.OPENAI_API_KEY,
-                http_client=http_client
-            )
+            self._client = get_openai_client()
         return self._client
     
     def _ensure_extension(self):
-        """Ensure pgvector extension is enabled."""
+        """Ensure pgvector extension is enabled (once per process)."""
+        global _extension_checked
+        if _extension_checked:
+            return
+        _extension_checked = True
         try:
             self.db.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
             self.db.commit()
@@ -44,17 +91,15 @@ class VectorStore:
             logger.warning(f"pgvector extension setup: {e}")
             self.db.rollback()
     
-    async def generate_embedding(self, text: str) -> List[float]:
+    async def generate_embedding(self, text: str) -> Sequence[float]:
         """
         Generate embedding for text using OpenAI.
         """
         if not text or not text.strip():
-            return [0.0] * settings.EMBEDDING_DIMENSION
+            return ZERO_EMBEDDING
         
         try:
-            text = text[:8000]
-            
-            response = self.client.embeddings.create(
+            response = await self.client.embeddings.create(
                 model=settings.OPENAI_EMBEDDING_MODEL,
                 input=text
             )
@@ -66,6 +111,61 @@ class VectorStore:
             logger.error(f"Error generating embedding: {str(e)}")
             raise
     
+    async def generate_embeddings_batch(self, texts: List[str]) -> List[Sequence[float]]:
+        """
+        Generate embeddings for many texts, EMBEDDING_BATCH_SIZE per request.
+        
+        Batches are sent concurrently, at most EMBEDDING_CONCURRENCY at a time.
+        Repeated texts (page headers, footers) are embedded once and shared.
+        """
+        embeddings: List[Sequence[float]] = [ZERO_EMBEDDING] * len(texts)
+        positions: Dict[str, List[int]] = {}
+        for i, t in enumerate(texts):
+            if t and t.strip():
+                positions.setdefault(t, []).append(i)
+        unique = list(positions)
+        
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        semaphore = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+        
+        async def embed_batch(batch):
+            async with semaphore:
+                response = await self.client.embeddings.create(
+                    model=settings.OPENAI_EMBEDDING_MODEL,
+                    input=batch
+                )
+            for t, item in zip(batch, response.data):
+                for i in positions[t]:
+                    embeddings[i] = item.embedding
+        
+        await asyncio.gather(*(
+            embed_batch(unique[start:start + batch_size])
+            for start in range(0, len(unique), batch_size)
+        ))
+        
+        return embeddings
+    
+    async def embed_query(self, text: str) -> Sequence[float]:
+        """
+        Generate a query embedding, batched with concurrent queries.
+        
+        Recent queries are answered from an in-process LRU cache.
+        """
+        if not text or not text.strip():
+            return ZERO_EMBEDDING
+        
+        text = text[:8000]
+        cached = _query_embedding_cache.get(text)
+        if cached is not None:
+            _query_embedding_cache.move_to_end(text)
+            return cached
+        
+        embedding = await query_embedding_batcher.process(text)
+        _query_embedding_cache[text] = embedding
+        if len(_query_embedding_cache) > settings.QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+        return embedding
+    
     async def store_chunk(
         self, 
         content: str, 
@@ -75,7 +175,7 @@ class VectorStore:
         metadata: Optional[Dict[str, Any]] = None
     ) -> DocumentChunk:
         """
-        Store a text chunk with its embedding.
+        Store a text chunk with its embedding; the caller commits.
         """
         embedding = await self.generate_embedding(content)
         
@@ -89,43 +189,79 @@ class VectorStore:
         )
         
         self.db.add(chunk)
-        self.db.commit()
-        self.db.refresh(chunk)
+        self.db.flush()
         
         return chunk
     
+    async def store_chunks_bulk(self, chunks: List[Dict[str, Any]], document_id: int) -> int:
+        """
+        Embed and store many text chunks; the caller commits.
+        """
+        if not chunks:
+            return 0
+        
+        embeddings = await self.generate_embeddings_batch([c["content"] for c in chunks])
+        
+        self.bulk_insert_chunks([
+            {
+                "document_id": document_id,
+                "content": chunk["content"],
+                "embedding": embedding,
+                "page_number": chunk["page_number"],
+                "chunk_index": chunk["chunk_index"],
+                "chunk_metadata": chunk.get("metadata") or {}
+            }
+            for chunk, embedding in zip(chunks, _halfvec_literals(embeddings))
+        ])
+        
+        return len(chunks)
+    
+    def bulk_insert_chunks(self, rows: List[Dict[str, Any]]):
+        """
+        Insert chunk rows with a single multi-row INSERT; the caller commits.
+        """
+        if rows:
+            self.db.execute(insert(DocumentChunk), rows)
+    
     async def similarity_search(
         self,
         query: str,
         document_id: Optional[int] = None,
-        k: int = 5
+        k: int = 5,
+        query_embedding: Optional[List[float]] = None
     ) -> List[Dict[str, Any]]:
         """
         Search for similar chunks using vector similarity.
         """
-        query_embedding = await self.generate_embedding(query)
-        
-        embedding_str = "[" + ",".join(map(str, query_embedding)) + "]"
+        if query_embedding is None:
+            query_embedding = await self.embed_query(query)
         
         if document_id:
+            # An HNSW scan filters by document only after picking hnsw.ef_search
+            # candidates from the whole table, so it can return fewer than k chunks.
+            # The materialized CTE fences the index off: the document's chunks come
+            # through the document_id index and are ranked exactly.
             sql = text("""
-                SELECT 
-                    id,
-                    document_id,
-                    content,
-                    page_number,
-                    chunk_index,
-                    metadata,
-                    1 - (embedding <=> CAST(:query_embedding AS vector)) as similarity
-                FROM document_chunks
-                WHERE document_id = :document_id
-                ORDER BY embedding <=> CAST(:query_embedding AS vector)
+                WITH candidates AS MATERIALIZED (
+                    SELECT 
+                        id,
+                        document_id,
+                        content,
+                        page_number,
+                        chunk_index,
+                        metadata,
+                        embedding <=> :query_embedding AS distance
+                    FROM document_chunks
+                    WHERE document_id = :document_id
+                )
+                SELECT * FROM candidates
+                ORDER BY distance
                 LIMIT :k
-            """)
+            """).bindparams(QUERY_VECTOR)
             result = self.db.execute(
                 sql,
                 {
-                    "query_embedding": embedding_str,
+                    "query_embedding": query_embedding,
                     "document_id": document_id,
                     "k": k
                 }
@@ -139,15 +275,15 @@ class VectorStore:
                     page_number,
                     chunk_index,
                     metadata,
-                    1 - (embedding <=> CAST(:query_embedding AS vector)) as similarity
+                    embedding <=> :query_embedding AS distance
                 FROM document_chunks
-                ORDER BY embedding <=> CAST(:query_embedding AS vector)
+                ORDER BY distance
                 LIMIT :k
-            """)
+            """).bindparams(QUERY_VECTOR)
             result = self.db.execute(
                 sql,
                 {
-                    "query_embedding": embedding_str,
+                    "query_embedding": query_embedding,
                     "k": k
                 }
             )
@@ -163,29 +299,31 @@ class VectorStore:
                 "page_number": row.page_number,
                 "chunk_index": row.chunk_index,
                 "metadata": row.metadata if row.metadata else {},
-                "score": float(row.similarity) if row.similarity else 0.0
+                "score": 1.0 - float(row.distance) if row.distance is not None else 0.0
             }
             chunks.append(chunk_data)
         
+        related = await self.get_related_content([chunk["id"] for chunk in chunks])
         for chunk in chunks:
-            related = await self.get_related_content([chunk["id"]])
-            chunk["related_images"] = related.get("images", [])
-            chunk["related_tables"] = related.get("tables", [])
+            content = related.get(chunk["id"], {})
+            chunk["related_images"] = content.get("images", [])
+            chunk["related_tables"] = content.get("tables", [])
         
         return chunks
     
     async def get_related_content(
         self,
         chunk_ids: List[int]
-    ) -> Dict[str, List[Dict[str, Any]]]:
+    ) -> Dict[int, Dict[str, List[Dict[str, Any]]]]:
         """
-        Get related images and tables for given chunks.
-        """
-        images = []
-        tables = []
+        Get related images and tables for given chunks, keyed by chunk id.
         
+        Media linked in a chunk's metadata is preferred; chunks without any
+        fall back to media from the same page. Images and tables are each
+        fetched with one query for all chunks.
+        """
         if not chunk_ids:
-            return {"images": images, "tables": tables}
+            return {}
         
         chunks = self.db.query(DocumentChunk).filter(
             DocumentChunk.id.in_(chunk_ids)
@@ -193,89 +331,84 @@ class VectorStore:
         
         image_ids = set()
         table_ids = set()
-        document_ids = set()
-        page_numbers = set()
+        pages = set()
         
         for chunk in chunks:
-            document_ids.add(chunk.document_id)
+            metadata = chunk.chunk_metadata or {}
+            image_ids.update(metadata.get("related_images", []))
+            table_ids.update(metadata.get("related_tables", []))
             if chunk.page_number:
-                page_numbers.add(chunk.page_number)
-            
-            if chunk.chunk_metadata:
-                if "related_images" in chunk.chunk_metadata:
-                    image_ids.update(chunk.chunk_metadata["related_images"])
-                if "related_tables" in chunk.chunk_metadata:
-                    table_ids.update(chunk.chunk_metadata["related_tables"])
+                pages.add((chunk.document_id, chunk.page_number))
         
-        if image_ids:
-            db_images = self.db.query(DocumentImage).filter(
-                DocumentImage.id.in_(image_ids)
-            ).all()
-            
-            for img in db_images:
-                import os
-                images.append({
-                    "id": img.id,
-                    "url": f"/uploads/images/{os.path.basename(img.file_path)}",
-                    "caption": img.caption,
-                    "page": img.page_number,
-                    "width": img.width,
-                    "height": img.height
-                })
+        images_by_id, images_by_page = self._fetch_media(DocumentImage, image_ids, pages)
+        tables_by_id, tables_by_page = self._fetch_media(DocumentTable, table_ids, pages)
         
-        if not images and document_ids and page_numbers:
-            db_images = self.db.query(DocumentImage).filter(
-                DocumentImage.document_id.in_(document_ids),
-                DocumentImage.page_number.in_(page_numbers)
-            ).limit(3).all()
+        related = {}
+        for chunk in chunks:
+            metadata = chunk.chunk_metadata or {}
+            page_key = (chunk.document_id, chunk.page_number)
             
-            for img in db_images:
-                import os
-                images.append({
-                    "id": img.id,
-                    "url": f"/uploads/images/{os.path.basename(img.file_path)}",
-                    "caption": img.caption,
-                    "page": img.page_number,
-                    "width": img.width,
-                    "height": img.height
-                })
-        
-        if table_ids:
-            db_tables = self.db.query(DocumentTable).filter(
-                DocumentTable.id.in_(table_ids)
-            ).all()
+            images = [images_by_id[i] for i in metadata.get("related_images", []) if i in images_by_id]
+            if not images and chunk.page_number:
+                images = images_by_page.get(page_key, [])[:3]
             
-            for tbl in db_tables:
-                import os
-                tables.append({
-                    "id": tbl.id,
-                    "url": f"/uploads/tables/{os.path.basename(tbl.image_path)}",
-                    "caption": tbl.caption,
-                    "page": tbl.page_number,
-                    "rows": tbl.rows,
-                    "columns": tbl.columns,
-                    "data": tbl.data
-                })
-        
-        if not tables and document_ids and page_numbers:
-            db_tables = self.db.query(DocumentTable).filter(
-                DocumentTable.document_id.in_(document_ids),
-                DocumentTable.page_number.in_(page_numbers)
-            ).limit(2).all()
+            tables = [tables_by_id[i] for i in metadata.get("related_tables", []) if i in tables_by_id]
+            if not tables and chunk.page_number:
+                tables = tables_by_page.get(page_key, [])[:2]
             
-            for tbl in db_tables:
-                import os
-                tables.append({
-                    "id": tbl.id,
-                    "url": f"/uploads/tables/{os.path.basename(tbl.image_path)}",
-                    "caption": tbl.caption,
-                    "page": tbl.page_number,
-                    "rows": tbl.rows,
-                    "columns": tbl.columns,
-                    "data": tbl.data
-                })
+            related[chunk.id] = {
+                "images": [self._image_dict(img) for img in images],
+                "tables": [self._table_dict(tbl) for tbl in tables]
+            }
         
-        return {"images": images, "tables": tables}
+        return related
+    
+    def _fetch_media(self, model, ids, pages):
+        """
+        Load media rows by id or by (document, page) in one query.
+        """
+        conditions = []
+        if ids:
+            conditions.append(model.id.in_(ids))
+        if pages:
+            conditions.append(and_(
+                model.document_id.in_({doc_id for doc_id, _ in pages}),
+                model.page_number.in_({page for _, page in pages})
+            ))
+        if not conditions:
+            return {}, {}
+        
+        rows = self.db.query(model).filter(or_(*conditions)).order_by(model.id).all()
+        
+        by_id = {row.id: row for row in rows}
+        by_page: Dict[tuple, list] = {}
+        for row in rows:
+            by_page.setdefault((row.document_id, row.page_number), []).append(row)
+        
+        return by_id, by_page
+    
+    @staticmethod
+    def _image_dict(img: DocumentImage) -> Dict[str, Any]:
+        return {
+            "id": img.id,
+            "url": f"/uploads/images/{img.file_name}",
+            "caption": img.caption,
+            "page": img.page_number,
+            "width": img.width,
+            "height": img.height
+        }
+    
+    @staticmethod
+    def _table_dict(tbl: DocumentTable) -> Dict[str, Any]:
+        return {
+            "id": tbl.id,
+            "url": f"/uploads/tables/{tbl.file_name}",
+            "caption": tbl.caption,
+            "page": tbl.page_number,
+            "rows": tbl.rows,
+            "columns": tbl.columns,
+            "data": tbl.data
+        }
     
     async def delete_document_chunks(self, document_id: int) -> int:
         """
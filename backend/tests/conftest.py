@@ -5,75 +5,24 @@ import pytest
 import os
 import sys
 import tempfile
-from unittest.mock import patch, MagicMock
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
 from sqlalchemy.pool import StaticPool
 
 
 TEST_DATABASE_URL = "sqlite:///:memory:"
 
+MOCK_EMBEDDING = (0.1,) * 1536
 
-@pytest.fixture(scope="session", autouse=True)
-def setup_test_environment():
-    """Set up test environment before importing app modules."""
-    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
-    os.environ["OPENAI_API_KEY"] = "test-key"
-    os.environ["REDIS_URL"] = "redis://localhost:6379/0"
-
-
-@pytest.fixture(scope="function")
-def db_engine():
-    """Create a test database engine."""
-    engine = create_engine(
-        TEST_DATABASE_URL,
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-    )
-    return engine
-
-
-@pytest.fixture(scope="function")
-def db_session(db_engine):
-    """Create a fresh database session for each test."""
-    from app.db.session import Base
-    
-    Base.metadata.create_all(bind=db_engine)
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
-    session = TestingSessionLocal()
-    try:
-        yield session
-    finally:
-        session.close()
-        Base.metadata.drop_all(bind=db_engine)
-
-
-@pytest.fixture(scope="function")
-def client(db_session, db_engine):
-    """Create a test client with overridden database dependency."""
-    from fastapi.testclient import TestClient
-    from app.db.session import get_db, Base
-    
-    def override_get_db():
-        try:
-            yield db_session
-        finally:
-            pass
-    
-    with patch('app.main.engine', db_engine):
-        with patch.object(Base.metadata, 'create_all'):
-            from app.main import app
-            app.dependency_overrides[get_db] = override_get_db
-            with TestClient(app) as test_client:
-                yield test_client
-            app.dependency_overrides.clear()
+# API integration tests start the whole app; don't even collect them unless asked to
+RUN_INTEGRATION = os.environ.get("RUN_INTEGRATION") == "1"
+collect_ignore_glob = [] if RUN_INTEGRATION else ["test_api.py"]
 
-
-@pytest.fixture
-def sample_pdf_content():
-    """Generate minimal PDF content for testing."""
-    pdf_content = b"""%PDF-1.4
+SAMPLE_PDF = b"""%PDF-1.4
 1 0 obj
 << /Type /Catalog /Pages 2 0 R >>
 endobj
@@ -101,12 +50,151 @@ trailer
 startxref
 300
 %%EOF"""
-    return pdf_content
+
+
+# Set up the test environment before any app module (and so settings) is imported;
+# the schema comes from db_engine, so the app must not create tables on import
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ["OPENAI_API_KEY"] = "test-key"
+os.environ["REDIS_URL"] = "redis://localhost:6379/0"
+os.environ["SEMANTIC_CACHE_ENABLED"] = "false"
+os.environ["SKIP_CREATE_ALL"] = "1"
+
+
+def pytest_configure(config):
+    """Create the test database engine and schema once per test run."""
+    from app.db.session import Base
+    from app.models import document, conversation  # noqa: F401 - register the tables
+    
+    # StaticPool keeps the single :memory: connection, and so the database, alive for the run
+    engine = create_engine(
+        TEST_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    
+    # pysqlite defers BEGIN on its own, which breaks SAVEPOINT handling;
+    # let SQLAlchemy emit BEGIN itself so per-test rollbacks are complete.
+    @event.listens_for(engine, "connect")
+    def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(engine, "begin")
+    def _emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+    
+    Base.metadata.create_all(bind=engine)
+    config._shared_engine = engine
+
+
+def pytest_unconfigure(config):
+    """Dispose of the shared test database engine."""
+    engine = getattr(config, "_shared_engine", None)
+    if engine is not None:
+        engine.dispose()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _estimate_token_length():
+    """Count tokens with the length estimate instead of loading the tiktoken encoding."""
+    with patch("app.services.document_processor._get_encoding", return_value=None):
+        yield
+
+
+@pytest.fixture(scope="session")
+def db_engine(request):
+    """The shared test database engine created in pytest_configure."""
+    return request.config._shared_engine
+
+
+@pytest.fixture(scope="function")
+def db_session(db_engine):
+    """
+    Database session isolated in a transaction that is rolled back after the test.
+    
+    Commits inside the test only release a SAVEPOINT, so no data outlives it.
+    """
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = Session(
+        bind=connection,
+        autoflush=False,
+        join_transaction_mode="create_savepoint"
+    )
+    try:
+        yield session
+    finally:
+        session.close()
+        transaction.rollback()
+        connection.close()
 
 
 @pytest.fixture
-def temp_upload_dir():
-    """Create a temporary upload directory for testing."""
+def sample_document(db_session):
+    """A processed Document row, flushed so it has an id."""
+    from app.models.document import Document
+    
+    document = Document(
+        filename="test.pdf",
+        file_path="/tmp/test.pdf",
+        processing_status="completed"
+    )
+    db_session.add(document)
+    db_session.flush()
+    return document
+
+
+@pytest.fixture(scope="session", autouse=RUN_INTEGRATION)
+def _app():
+    """
+    Import the FastAPI app once; SKIP_CREATE_ALL keeps it off the database schema.
+    
+    Preloaded at session start when the API tests are collected.
+    """
+    from app.main import app
+    return app
+
+
+@pytest.fixture(scope="session")
+def _test_client(_app):
+    """A single TestClient (and app lifespan) shared by the session."""
+    from fastapi.testclient import TestClient
+    
+    with TestClient(_app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="function")
+def client(_app, _test_client, db_session):
+    """
+    Create a test client bound to the shared test engine through db_session.
+    
+    Request handlers get db_session itself; sessions the app opens on its own
+    (background tasks) join the same connection, inside its own SAVEPOINT.
+    """
+    from app.db.session import get_db, SessionLocal
+    
+    def override_get_db():
+        yield db_session
+    
+    _app.dependency_overrides[get_db] = override_get_db
+    try:
+        with patch.dict(SessionLocal.kw, bind=db_session.bind, join_transaction_mode="create_savepoint"):
+            yield _test_client
+    finally:
+        _app.dependency_overrides.clear()
+        _test_client.cookies.clear()
+
+
+@pytest.fixture(scope="session")
+def sample_pdf_content():
+    """Minimal PDF content for testing."""
+    return SAMPLE_PDF
+
+
+@pytest.fixture(scope="session")
+def _upload_root():
+    """Create the temporary upload directory tree once per session."""
     with tempfile.TemporaryDirectory() as tmpdir:
         os.makedirs(os.path.join(tmpdir, "documents"), exist_ok=True)
         os.makedirs(os.path.join(tmpdir, "images"), exist_ok=True)
@@ -115,30 +203,25 @@ def temp_upload_dir():
 
 
 @pytest.fixture
-def mock_openai_embedding(mocker):
+def temp_upload_dir(_upload_root):
+    """Temporary upload directory for testing, emptied of files after each test."""
+    yield _upload_root
+    for path in Path(_upload_root).rglob("*"):
+        if path.is_file():
+            path.unlink()
+
+
+@pytest.fixture
+def mock_openai_embedding():
     """Mock OpenAI embedding response."""
-    mock_response = mocker.MagicMock()
-    mock_response.data = [mocker.MagicMock(embedding=[0.1] * 1536)]
-    
-    mock_client = mocker.MagicMock()
-    mock_client.embeddings.create.return_value = mock_response
-    
-    return mock_client
+    response = SimpleNamespace(data=[SimpleNamespace(embedding=MOCK_EMBEDDING)])
+    # A fresh AsyncMock per test, so call history and side effects never leak between tests
+    return SimpleNamespace(embeddings=SimpleNamespace(create=AsyncMock(return_value=response)))
 
 
 @pytest.fixture
-def mock_openai_chat(mocker):
+def mock_openai_chat():
     """Mock OpenAI chat completion response."""
-    mock_message = mocker.MagicMock()
-    mock_message.content = "This is a test response from the AI."
-    
-    mock_choice = mocker.MagicMock()
-    mock_choice.message = mock_message
-    
-    mock_response = mocker.MagicMock()
-    mock_response.choices = [mock_choice]
-    
-    mock_client = mocker.MagicMock()
-    mock_client.chat.completions.create.return_value = mock_response
-    
-    return mock_client
+    mock_message = SimpleNamespace(content="This is a test response from the AI.")
+    response = SimpleNamespace(choices=[SimpleNamespace(message=mock_message)])
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=AsyncMock(return_value=response))))
@@ -1,19 +1,14 @@
 """
 Integration tests for API endpoints.
 
-Note: These tests require PostgreSQL to be running. 
-Skip with: pytest tests/ --ignore=tests/test_api.py
-Or run in Docker where all services are available.
+Note: These tests run the app against the shared SQLite test engine and are
+only collected with RUN_INTEGRATION=1 set.
 """
 import pytest
 import io
-from unittest.mock import patch, MagicMock
-
-# Skip all tests in this module if we can't connect to the test database
-pytestmark = pytest.mark.skipif(
-    True,  # Skip by default when running locally
-    reason="API integration tests require PostgreSQL. Run with Docker."
-)
+import json
+import os
+from unittest.mock import patch, MagicMock, AsyncMock
 
 
 class TestDocumentAPI:
@@ -52,6 +47,21 @@ class TestDocumentAPI:
             assert data["status"] == "pending"
             assert "id" in data
     
+    def test_upload_document_too_large(self, client, db_session, sample_pdf_content, temp_upload_dir):
+        """Test that an oversized upload is rejected and its partial file removed."""
+        from app.models.document import Document
+        
+        with pytest.MonkeyPatch().context() as mp:
+            mp.setattr("app.core.config.settings.UPLOAD_DIR", temp_upload_dir)
+            mp.setattr("app.core.config.settings.MAX_FILE_SIZE", 64)
+            
+            files = {"file": ("test.pdf", io.BytesIO(sample_pdf_content), "application/pdf")}
+            response = client.post("/api/documents/upload", files=files)
+        
+            assert response.status_code == 413
+            assert os.listdir(os.path.join(temp_upload_dir, "documents")) == []
+            assert db_session.query(Document).count() == 0
+    
     def test_get_document_not_found(self, client):
         """Test getting non-existent document."""
         response = client.get("/api/documents/9999")
@@ -63,6 +73,24 @@ class TestDocumentAPI:
         response = client.delete("/api/documents/9999")
         
         assert response.status_code == 404
+    
+    @pytest.mark.parametrize("path", ["/api/documents", "/api/documents/{id}"])
+    def test_document_etag(self, client, db_session, sample_document, path):
+        """Test that a matching If-None-Match gets 304 until the document changes."""
+        url = path.format(id=sample_document.id)
+        etag = client.get(url).headers["etag"]
+        
+        not_modified = client.get(url, headers={"If-None-Match": etag})
+        
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        
+        sample_document.processing_status = "error"
+        db_session.flush()
+        response = client.get(url, headers={"If-None-Match": etag})
+        
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
 
 
 class TestChatAPI:
@@ -77,6 +105,29 @@ class TestChatAPI:
         
         assert response.status_code == 404
     
+    def test_stream_message_saves_answer(self, client, db_session):
+        """Test that deltas are streamed as SSE and the full answer is stored."""
+        from app.models.conversation import Message
+        from app.services.chat_engine import ChatEngine
+        
+        async def stream_answer(self, message, document_id, turn):
+            for delta in ["Hel", "lo"]:
+                yield delta
+        
+        with patch.object(ChatEngine, "prepare_turn", AsyncMock(return_value={"sources": []})), \
+                patch.object(ChatEngine, "stream_answer", stream_answer):
+            response = client.post("/api/chat/stream", json={"message": "Hello"})
+        
+        assert response.status_code == 200
+        events = [json.loads(line[len("data: "):]) for line in response.text.split("\n\n") if line]
+        assert [e["delta"] for e in events[:-1]] == ["Hel", "lo"]
+        assert events[-1]["done"] is True
+        
+        message = db_session.get(Message, events[-1]["message_id"])
+        assert message.role == "assistant"
+        assert message.content == "Hello"
+        assert message.conversation_id == events[-1]["conversation_id"]
+    
     def test_list_conversations_empty(self, client):
         """Test listing conversations when none exist."""
         response = client.get("/api/chat/conversations")
@@ -92,6 +143,28 @@ class TestChatAPI:
         
         assert response.status_code == 404
     
+    def test_get_conversation_etag(self, client, db_session):
+        """Test that a matching If-None-Match gets 304 until a message is added."""
+        from app.models.conversation import Conversation, Message
+        
+        conversation = Conversation(title="Test")
+        db_session.add(conversation)
+        db_session.flush()
+        url = f"/api/chat/conversations/{conversation.id}"
+        etag = client.get(url).headers["etag"]
+        
+        not_modified = client.get(url, headers={"If-None-Match": etag})
+        
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        
+        db_session.add(Message(conversation_id=conversation.id, role="user", content="Hello"))
+        db_session.flush()
+        response = client.get(url, headers={"If-None-Match": etag})
+        
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+    
     def test_delete_conversation_not_found(self, client):
         """Test deleting non-existent conversation."""
         response = client.delete("/api/chat/conversations/9999")
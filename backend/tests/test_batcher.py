@@ -0,0 +1,34 @@
+"""
+Unit tests for AsyncBatcher.
+"""
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from app.services.batcher import AsyncBatcher
+
+
+class TestAsyncBatcher:
+    """Tests for AsyncBatcher class."""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_items_share_one_batch(self):
+        """Test that concurrent callers are batched and each gets its own result."""
+        process_batch = AsyncMock(side_effect=lambda items: [item * 2 for item in items])
+        batcher = AsyncBatcher(process_batch, max_batch=8, max_wait_ms=5)
+        
+        results = await asyncio.gather(*(batcher.process(i) for i in range(3)))
+        
+        assert results == [0, 2, 4]
+        process_batch.assert_called_once_with([0, 1, 2])
+    
+    @pytest.mark.asyncio
+    async def test_result_count_mismatch_fails_every_caller(self):
+        """Test that a short result list fails the whole batch instead of leaving callers waiting."""
+        batcher = AsyncBatcher(AsyncMock(return_value=["only one"]), max_batch=8, max_wait_ms=5)
+        
+        results = await asyncio.wait_for(
+            asyncio.gather(*(batcher.process(i) for i in range(3)), return_exceptions=True),
+            timeout=1
+        )
+        
+        assert all(isinstance(result, ValueError) for result in results)
@@ -3,8 +3,8 @@ Unit tests for ChatEngine service.
 """
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
+from sqlalchemy import insert
 from app.services.chat_engine import ChatEngine
-from app.models.document import Document
 from app.models.conversation import Conversation, Message
 
 
@@ -23,7 +23,7 @@ class TestChatEngine:
         """Test loading history for conversation with no messages."""
         conversation = Conversation(title="Test", document_id=None)
         db_session.add(conversation)
-        db_session.commit()
+        db_session.flush()
         
         engine = ChatEngine(db_session)
         history = await engine._load_conversation_history(conversation.id)
@@ -35,20 +35,12 @@ class TestChatEngine:
         """Test loading history with messages."""
         conversation = Conversation(title="Test", document_id=None)
         db_session.add(conversation)
-        db_session.commit()
+        db_session.flush()
         
-        msg1 = Message(
-            conversation_id=conversation.id,
-            role="user",
-            content="Hello"
-        )
-        msg2 = Message(
-            conversation_id=conversation.id,
-            role="assistant",
-            content="Hi there!"
-        )
-        db_session.add_all([msg1, msg2])
-        db_session.commit()
+        db_session.execute(insert(Message), [
+            {"conversation_id": conversation.id, "role": "user", "content": "Hello"},
+            {"conversation_id": conversation.id, "role": "assistant", "content": "Hi there!"}
+        ])
         
         engine = ChatEngine(db_session)
         history = await engine._load_conversation_history(conversation.id)
@@ -59,6 +51,23 @@ class TestChatEngine:
         assert history[1]["role"] == "assistant"
         assert history[1]["content"] == "Hi there!"
     
+    @pytest.mark.asyncio
+    async def test_load_conversation_history_keeps_latest_in_order(self, db_session):
+        """Test that only the most recent turns are returned, oldest first."""
+        conversation = Conversation(title="Test", document_id=None)
+        db_session.add(conversation)
+        db_session.flush()
+        
+        db_session.execute(insert(Message), [
+            {"conversation_id": conversation.id, "role": "user", "content": f"Message {i}"}
+            for i in range(6)
+        ])
+        
+        engine = ChatEngine(db_session)
+        history = await engine._load_conversation_history(conversation.id, limit=2)
+        
+        assert [h["content"] for h in history] == [f"Message {i}" for i in range(2, 6)]
+    
     @pytest.mark.asyncio
     async def test_find_related_media_empty(self, db_session):
         """Test finding related media with no context."""
@@ -69,21 +78,13 @@ class TestChatEngine:
         assert "tables" in result
     
     @pytest.mark.asyncio
-    async def test_find_related_media_image_keywords(self, db_session):
+    async def test_find_related_media_image_keywords(self, db_session, sample_document):
         """Test that image keywords trigger image search."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="completed"
-        )
-        db_session.add(document)
-        db_session.commit()
-        
         engine = ChatEngine(db_session)
         
         result = await engine._find_related_media(
             [], 
-            document.id, 
+            sample_document.id, 
             "Show me the architecture diagram"
         )
         
@@ -91,27 +92,96 @@ class TestChatEngine:
         assert "tables" in result
     
     @pytest.mark.asyncio
-    async def test_find_related_media_table_keywords(self, db_session):
+    async def test_find_related_media_table_keywords(self, db_session, sample_document):
         """Test that table keywords trigger table search."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="completed"
-        )
-        db_session.add(document)
-        db_session.commit()
-        
         engine = ChatEngine(db_session)
         
         result = await engine._find_related_media(
             [], 
-            document.id, 
+            sample_document.id, 
             "What are the experimental results?"
         )
         
         assert "images" in result
         assert "tables" in result
     
+    @pytest.mark.asyncio
+    async def test_find_related_media_skips_db_when_context_suffices(self, db_session, sample_document):
+        """Test that no fallback query runs when chunks already carry enough media."""
+        context = [{
+            "related_images": [{"id": i, "url": f"/uploads/images/{i}.png"} for i in range(1, 4)],
+            "related_tables": [{"id": i, "url": f"/uploads/tables/{i}.png"} for i in range(1, 3)]
+        }]
+        engine = ChatEngine(db_session)
+        
+        with patch.object(db_session, 'query', wraps=db_session.query) as mock_query:
+            result = await engine._find_related_media(
+                context,
+                sample_document.id,
+                "Show me the table of results"
+            )
+        
+        mock_query.assert_not_called()
+        assert len(result["images"]) == 3
+        assert len(result["tables"]) == 2
+    
+    @pytest.mark.asyncio
+    async def test_generate_response_skips_duplicate_question(self, db_session, mock_openai_chat):
+        """Test that the stored current question is not resent as history."""
+        engine = ChatEngine(db_session)
+        engine._client = mock_openai_chat
+        history = [
+            {"role": "user", "content": "Earlier question"},
+            {"role": "assistant", "content": "Earlier answer"},
+            {"role": "user", "content": "Current question"},
+        ]
+        
+        answer = await engine._generate_response(
+            "Current question", [], history, {"images": [], "tables": []}
+        )
+        
+        assert answer == "This is a test response from the AI."
+        messages = mock_openai_chat.chat.completions.create.call_args.kwargs["messages"]
+        assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+        assert messages[-1]["content"].startswith("Based on the following document context")
+    
+    @pytest.mark.asyncio
+    async def test_stream_answer_cached(self, db_session):
+        """Test that a cached turn streams the stored answer in one piece."""
+        engine = ChatEngine(db_session)
+        turn = {"query_embedding": [0.1] * 1536, "cached": {"answer": "Cached"}, "cacheable": True, "sources": []}
+        
+        parts = [delta async for delta in engine.stream_answer("Question", None, turn)]
+        
+        assert parts == ["Cached"]
+    
+    @pytest.mark.asyncio
+    async def test_stream_answer_yields_deltas(self, db_session):
+        """Test that streamed completion deltas are yielded and cached when done."""
+        async def fake_stream():
+            for text in ["Hel", None, "lo"]:
+                yield MagicMock(choices=[MagicMock(delta=MagicMock(content=text))])
+        
+        engine = ChatEngine(db_session)
+        engine._client = MagicMock()
+        engine._client.chat.completions.create = AsyncMock(return_value=fake_stream())
+        engine.semantic_cache = MagicMock(set_answer=AsyncMock())
+        turn = {
+            "query_embedding": [0.1] * 1536,
+            "cached": None,
+            "cacheable": True,
+            "history": [],
+            "context": [],
+            "media": {"images": [], "tables": []},
+            "sources": []
+        }
+        
+        parts = [delta async for delta in engine.stream_answer("Question", 1, turn)]
+        
+        assert parts == ["Hel", "lo"]
+        assert engine._client.chat.completions.create.call_args.kwargs["stream"] is True
+        engine.semantic_cache.set_answer.assert_called_once_with(1, turn["query_embedding"], "Hello", [])
+    
     def test_build_system_prompt(self, db_session):
         """Test system prompt building."""
         engine = ChatEngine(db_session)
@@ -182,9 +252,11 @@ class TestChatEngine:
         """Test that process_message handles errors gracefully."""
         conversation = Conversation(title="Test", document_id=None)
         db_session.add(conversation)
-        db_session.commit()
+        db_session.flush()
         
         engine = ChatEngine(db_session)
+        engine.vector_store.embed_query = AsyncMock(return_value=[0.1] * 1536)
+        engine.semantic_cache = MagicMock(get_answer=AsyncMock(return_value=None))
         
         with patch.object(engine, '_search_context', side_effect=Exception("Test error")):
             result = await engine.process_message(
@@ -196,4 +268,52 @@ class TestChatEngine:
         assert "answer" in result
         assert "sources" in result
         assert "processing_time" in result
-
+    
+    @pytest.mark.asyncio
+    async def test_process_message_semantic_cache_hit(self, db_session):
+        """Test that a cached answer skips search and generation."""
+        conversation = Conversation(title="Test", document_id=None)
+        db_session.add(conversation)
+        db_session.flush()
+        
+        engine = ChatEngine(db_session)
+        engine.vector_store.embed_query = AsyncMock(return_value=[0.1] * 1536)
+        engine.semantic_cache = MagicMock(get_answer=AsyncMock(return_value={
+            "answer": "Cached answer",
+            "sources": [{"type": "text", "content": "Cached"}]
+        }))
+        
+        with patch.object(engine, '_search_context') as mock_search, \
+                patch.object(engine, '_generate_response') as mock_generate:
+            result = await engine.process_message(conversation.id, "Test message", None)
+        
+        assert result["answer"] == "Cached answer"
+        assert len(result["sources"]) == 1
+        mock_search.assert_not_called()
+        mock_generate.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_process_message_follow_up_skips_answer_cache(self, db_session):
+        """Test that a follow-up with earlier turns neither reads nor writes cached answers."""
+        conversation = Conversation(title="Test", document_id=None)
+        db_session.add(conversation)
+        db_session.flush()
+        db_session.add_all([
+            Message(conversation_id=conversation.id, role="user", content="Earlier question"),
+            Message(conversation_id=conversation.id, role="assistant", content="Earlier answer"),
+            Message(conversation_id=conversation.id, role="user", content="And then?")
+        ])
+        db_session.flush()
+        
+        engine = ChatEngine(db_session)
+        engine.vector_store.embed_query = AsyncMock(return_value=[0.1] * 1536)
+        engine.semantic_cache = MagicMock(get_answer=AsyncMock(), set_answer=AsyncMock())
+        
+        with patch.object(engine, '_search_context', AsyncMock(return_value=[])), \
+                patch.object(engine, '_generate_response', AsyncMock(return_value="Follow-up answer")) as mock_generate:
+            result = await engine.process_message(conversation.id, "And then?", None)
+        
+        assert result["answer"] == "Follow-up answer"
+        assert [h["content"] for h in mock_generate.call_args.args[2]] == ["Earlier question", "Earlier answer"]
+        engine.semantic_cache.get_answer.assert_not_called()
+        engine.semantic_cache.set_answer.assert_not_called()
@@ -3,8 +3,8 @@ Unit tests for DocumentProcessor service.
 """
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
-from app.services.document_processor import DocumentProcessor
-from app.models.document import Document
+from app.services.document_processor import DocumentProcessor, _get_image_pool, _render_table_png, _token_length
+from app.models.document import DocumentChunk, DocumentImage
 
 
 class TestDocumentProcessor:
@@ -16,6 +16,17 @@ class TestDocumentProcessor:
         assert processor.db == db_session
         assert processor.vector_store is not None
         assert processor.text_splitter is not None
+        assert DocumentProcessor(db_session).text_splitter is processor.text_splitter
+    
+    def test_text_splitter_counts_tokens(self, db_session):
+        """Test that chunk size is measured in tokens, not characters."""
+        processor = DocumentProcessor(db_session)
+        text = "token " * 2000
+        chunks = processor.text_splitter.split_text(text)
+        
+        assert len(chunks) > 1
+        assert all(_token_length(chunk) <= processor.text_splitter._chunk_size for chunk in chunks)
+        assert _token_length("") == 0
     
     def test_chunk_text_empty(self, db_session):
         """Test text chunking with empty input."""
@@ -55,45 +66,94 @@ class TestDocumentProcessor:
         for chunk in chunks:
             assert "related_images" in chunk["metadata"]
             assert "related_tables" in chunk["metadata"]
+        assert chunks[0]["metadata"]["related_images"] == [101, 102, 103]
+        assert chunks[0]["metadata"]["related_tables"] == [201]
+    
+    def test_chunk_document_uses_item_pages(self, db_session):
+        """Test chunking Docling items by their provenance page."""
+        processor = DocumentProcessor(db_session)
+        
+        def item(text, page):
+            return MagicMock(text=text, prov=[MagicMock(page_no=page)])
+        
+        doc = MagicMock()
+        doc.iterate_items.return_value = [
+            (item("First page text.", 1), 0),
+            (MagicMock(text=None), 0),
+            (item("Third page text.", 3), 0),
+            (item("More on page one.", 1), 0),
+        ]
+        
+        chunks = processor._chunk_document(doc, 1, {3: [7]}, {1: [9]})
+        
+        assert [c["page_number"] for c in chunks] == [1, 3]
+        assert "More on page one." in chunks[0]["content"]
+        assert chunks[0]["metadata"]["related_tables"] == [9]
+        assert chunks[1]["metadata"]["related_images"] == [7]
+        assert [c["chunk_index"] for c in chunks] == [0, 1]
+        doc.export_to_markdown.assert_not_called()
+    
+    def test_chunk_document_includes_tables(self, db_session):
+        """Test that table items, which have no text, are chunked as caption plus markdown."""
+        processor = DocumentProcessor(db_session)
+        table = MagicMock(label="table", text=None, prov=[MagicMock(page_no=2)])
+        table.caption_text.return_value = "Quarterly revenue"
+        table.export_to_markdown.return_value = "| Quarter | Revenue |\n| Q1 | 100 |"
+        
+        doc = MagicMock()
+        doc.iterate_items.return_value = [
+            (MagicMock(text="Intro text.", prov=[MagicMock(page_no=2)]), 0),
+            (table, 0),
+        ]
+        
+        chunks = processor._chunk_document(doc, 1, {}, {})
+        
+        assert len(chunks) == 1
+        assert chunks[0]["page_number"] == 2
+        assert "Quarterly revenue" in chunks[0]["content"]
+        assert "| Q1 | 100 |" in chunks[0]["content"]
+        table.export_to_markdown.assert_called_once_with(doc=doc)
+    
+    def test_chunk_document_falls_back_to_markdown(self, db_session):
+        """Test chunking falls back to the markdown export without text items."""
+        processor = DocumentProcessor(db_session)
+        doc = MagicMock()
+        doc.iterate_items.return_value = []
+        doc.export_to_markdown.return_value = "Fallback text. " * 10
+        
+        chunks = processor._chunk_document(doc, 1, {}, {})
+        
+        assert len(chunks) == 1
+        assert chunks[0]["page_number"] == 1
     
     @pytest.mark.asyncio
-    async def test_update_document_status(self, db_session):
+    async def test_update_document_status(self, db_session, sample_document):
         """Test document status update."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="pending"
-        )
-        db_session.add(document)
-        db_session.commit()
+        sample_document.processing_status = "pending"
+        db_session.flush()
         
         processor = DocumentProcessor(db_session)
-        await processor._update_document_status(document.id, "processing")
+        await processor._update_document_status(sample_document.id, "processing")
         
-        db_session.refresh(document)
-        assert document.processing_status == "processing"
+        db_session.refresh(sample_document)
+        assert sample_document.processing_status == "processing"
     
     @pytest.mark.asyncio
-    async def test_update_document_status_with_error(self, db_session):
+    async def test_update_document_status_with_error(self, db_session, sample_document):
         """Test document status update with error message."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="processing"
-        )
-        db_session.add(document)
-        db_session.commit()
+        sample_document.processing_status = "processing"
+        db_session.flush()
         
         processor = DocumentProcessor(db_session)
         await processor._update_document_status(
-            document.id, 
+            sample_document.id, 
             "error", 
             "Test error message"
         )
         
-        db_session.refresh(document)
-        assert document.processing_status == "error"
-        assert document.error_message == "Test error message"
+        db_session.refresh(sample_document)
+        assert sample_document.processing_status == "error"
+        assert sample_document.error_message == "Test error message"
     
     def test_render_table_as_image_empty(self, db_session):
         """Test table rendering with empty data."""
@@ -131,3 +191,147 @@ class TestDocumentProcessor:
         assert img.width > 0
         assert img.height > 0
 
+    
+    def test_render_table_png_writes_file(self, tmp_path):
+        """Test the pool-side table renderer writes a PNG file."""
+        from PIL import Image
+        
+        file_path = str(tmp_path / "table.png")
+        _render_table_png([{"A": "1", "B": "2"}], "Table", file_path)
+        
+        with Image.open(file_path) as img:
+            assert img.format == "PNG"
+    
+    def test_image_pool_does_not_fork(self):
+        """Test that pool workers start clean instead of forking the app's clients and models."""
+        assert _get_image_pool()._mp_context.get_start_method() in ("forkserver", "spawn")
+    
+    def test_render_table_as_svg_empty(self, db_session):
+        """Test SVG table rendering with empty data."""
+        processor = DocumentProcessor(db_session)
+        svg = processor._render_table_as_svg(None, "Test Table")
+        
+        assert svg.startswith("<svg")
+        assert "Empty table" in svg
+    
+    def test_render_table_as_svg_escapes_cells(self, db_session):
+        """Test SVG table rendering with dictionary data."""
+        processor = DocumentProcessor(db_session)
+        table_data = [
+            {"Name": "Alice & Bob", "Age": "25"},
+            {"Name": "<Carol>", "Age": "30"},
+        ]
+        svg = processor._render_table_as_svg(table_data, "People Table")
+        
+        assert svg.endswith("</svg>")
+        assert "Alice &amp; Bob" in svg
+        assert "&lt;Carol&gt;" in svg
+        assert "People Table" in svg
+    
+    @pytest.mark.asyncio
+    async def test_save_image_keeps_rgb_png_bytes(self, db_session, sample_document, tmp_path):
+        """Test that RGB PNGs are written as-is instead of re-encoded."""
+        import io
+        from PIL import Image
+        
+        buffer = io.BytesIO()
+        Image.new('RGB', (20, 10), color='red').save(buffer, format='PNG')
+        image_data = buffer.getvalue()
+        
+        processor = DocumentProcessor(db_session)
+        processor.upload_dir = str(tmp_path)
+        (tmp_path / "images").mkdir()
+        
+        doc_image = await processor._save_image(image_data, sample_document.id, 1, {})
+        
+        assert (doc_image.width, doc_image.height) == (20, 10)
+        with open(doc_image.file_path, 'rb') as f:
+            assert f.read() == image_data
+    
+    @pytest.mark.asyncio
+    async def test_save_image_accepts_pil_image(self, db_session, sample_document, tmp_path):
+        """Test saving a decoded PIL image without a bytes round-trip."""
+        from PIL import Image
+        
+        processor = DocumentProcessor(db_session)
+        processor.upload_dir = str(tmp_path)
+        (tmp_path / "images").mkdir()
+        
+        doc_image = await processor._save_image(Image.new('RGBA', (8, 6)), sample_document.id, 2, {})
+        
+        assert (doc_image.width, doc_image.height) == (8, 6)
+        with Image.open(doc_image.file_path) as saved:
+            assert saved.mode == 'RGB'
+    
+    @pytest.mark.asyncio
+    async def test_process_document_commits_once(self, db_session, sample_document, mocker):
+        """Test that ingest commits only the status handshake and the final result."""
+        doc = MagicMock(pictures=[], tables=[], pages=[])
+        doc.iterate_items.return_value = [
+            (MagicMock(text="Some page text.", prov=[MagicMock(page_no=1)]), 0)
+        ]
+        converter = MagicMock()
+        converter.convert.return_value = MagicMock(document=doc)
+        mocker.patch("app.services.document_processor._get_converter", return_value=converter)
+        
+        processor = DocumentProcessor(db_session)
+        processor.vector_store.generate_embeddings_batch = AsyncMock(return_value=[[0.1] * 1536])
+        commit = mocker.spy(db_session, "commit")
+        
+        result = await processor.process_document("/tmp/test.pdf", sample_document.id)
+        
+        assert result["status"] == "success"
+        assert result["text_chunks"] == 1
+        assert commit.call_count == 2
+        db_session.refresh(sample_document)
+        assert sample_document.processing_status == "completed"
+    
+    @pytest.mark.asyncio
+    async def test_process_document_fails_when_embedding_fails(self, db_session, sample_document, mocker):
+        """Test that a failed embedding request marks the document as errored, not completed."""
+        doc = MagicMock(pictures=[], tables=[], pages=[])
+        doc.iterate_items.return_value = [
+            (MagicMock(text="Some page text.", prov=[MagicMock(page_no=1)]), 0)
+        ]
+        converter = MagicMock()
+        converter.convert.return_value = MagicMock(document=doc)
+        mocker.patch("app.services.document_processor._get_converter", return_value=converter)
+        
+        processor = DocumentProcessor(db_session)
+        processor.vector_store.generate_embeddings_batch = AsyncMock(side_effect=RuntimeError("rate limited"))
+        
+        result = await processor.process_document("/tmp/test.pdf", sample_document.id)
+        
+        assert result["status"] == "error"
+        db_session.refresh(sample_document)
+        assert sample_document.processing_status == "error"
+        assert sample_document.error_message == "rate limited"
+        assert db_session.query(DocumentChunk).filter_by(document_id=sample_document.id).count() == 0
+    
+    @pytest.mark.asyncio
+    async def test_process_document_removes_files_on_failure(self, db_session, sample_document, mocker, tmp_path):
+        """Test that image files written before a failed ingest are deleted with its rows."""
+        import io
+        from PIL import Image
+        
+        png = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(png, format='PNG')
+        picture = MagicMock(image=png.getvalue(), caption="Figure", prov=[MagicMock(page_no=1)])
+        doc = MagicMock(pictures=[picture], tables=[], pages=[])
+        doc.iterate_items.return_value = [
+            (MagicMock(text="Some page text.", prov=[MagicMock(page_no=1)]), 0)
+        ]
+        converter = MagicMock()
+        converter.convert.return_value = MagicMock(document=doc)
+        mocker.patch("app.services.document_processor._get_converter", return_value=converter)
+        
+        processor = DocumentProcessor(db_session)
+        processor.upload_dir = str(tmp_path)
+        (tmp_path / "images").mkdir()
+        processor.vector_store.generate_embeddings_batch = AsyncMock(side_effect=RuntimeError("rate limited"))
+        
+        result = await processor.process_document("/tmp/test.pdf", sample_document.id)
+        
+        assert result["status"] == "error"
+        assert list((tmp_path / "images").iterdir()) == []
+        assert db_session.query(DocumentImage).filter_by(document_id=sample_document.id).count() == 0
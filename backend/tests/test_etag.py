@@ -0,0 +1,71 @@
+"""
+Unit tests for conditional GET helpers.
+"""
+from datetime import datetime
+from fastapi import Request, Response
+from app.api.etag import weak_etag, check_etag, CACHE_CONTROL
+
+
+def _request(if_none_match=None):
+    """Build a bare HTTP request, optionally with an If-None-Match header."""
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "headers": headers})
+
+
+class TestEtag:
+    """Tests for weak_etag and check_etag."""
+    
+    def test_weak_etag(self):
+        """Test that the ETag combines the modification time and count."""
+        updated_at = datetime(2024, 1, 1, 12, 0, 0)
+        
+        assert weak_etag(updated_at, 3) == f'W/"{updated_at.timestamp()}-3"'
+    
+    def test_weak_etag_without_updated_at(self):
+        """Test that an empty table still gets a stable ETag."""
+        assert weak_etag(None, 0) == 'W/"0-0"'
+        assert weak_etag(None, 0) != weak_etag(None, 1)
+    
+    def test_check_etag_match_returns_304(self):
+        """Test that a matching If-None-Match returns 304 with cache headers."""
+        etag = weak_etag(None, 2)
+        response = Response()
+        
+        not_modified = check_etag(_request(etag), response, etag)
+        
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == etag
+        assert not_modified.headers["cache-control"] == CACHE_CONTROL
+    
+    def test_check_etag_mismatch(self):
+        """Test that a stale ETag gets the headers on the normal response."""
+        etag = weak_etag(None, 2)
+        response = Response()
+        
+        not_modified = check_etag(_request(weak_etag(None, 1)), response, etag)
+        
+        assert not_modified is None
+        assert response.headers["etag"] == etag
+        assert response.headers["cache-control"] == CACHE_CONTROL
+    
+    def test_check_etag_without_header(self):
+        """Test that a request without If-None-Match is served normally."""
+        response = Response()
+        
+        assert check_etag(_request(), response, weak_etag(None, 0)) is None
+        assert "etag" in response.headers
+    
+    def test_check_etag_wildcard(self):
+        """Test that If-None-Match: * matches any ETag."""
+        not_modified = check_etag(_request("*"), Response(), weak_etag(None, 5))
+        
+        assert not_modified.status_code == 304
+    
+    def test_check_etag_list(self):
+        """Test that any ETag in a comma-separated list matches."""
+        etag = weak_etag(None, 2)
+        header = f'{weak_etag(None, 1)}, {etag} ,W/"other"'
+        
+        not_modified = check_etag(_request(header), Response(), etag)
+        
+        assert not_modified.status_code == 304
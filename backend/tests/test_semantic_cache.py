@@ -0,0 +1,167 @@
+"""
+Unit tests for SemanticCache service.
+"""
+import json
+import pytest
+import numpy as np
+from unittest.mock import MagicMock, AsyncMock
+from app.services.semantic_cache import SemanticCache
+
+
+@pytest.fixture(autouse=True)
+def _cache_enabled(mocker):
+    """The test environment disables the cache; these tests drive it against a mock Redis."""
+    mocker.patch("app.services.semantic_cache.settings.SEMANTIC_CACHE_ENABLED", True)
+
+
+def _redis_with_pipeline(*results):
+    """Redis client mock whose successive pipelines return the given execute() results."""
+    pipe = MagicMock(execute=AsyncMock(side_effect=list(results)))
+    client = MagicMock()
+    client.pipeline.return_value.__aenter__.return_value = pipe
+    return client
+
+
+class TestSemanticCache:
+    """Tests for SemanticCache class."""
+    
+    def test_init(self):
+        """Test SemanticCache initialization."""
+        cache = SemanticCache()
+        assert cache._client is None
+    
+    def test_client_uses_socket_timeouts(self):
+        """Test that an unreachable Redis fails fast instead of stalling requests."""
+        cache = SemanticCache()
+        
+        pool_kwargs = cache.client.connection_pool.connection_kwargs
+        
+        assert pool_kwargs["socket_connect_timeout"] == 0.5
+        assert pool_kwargs["socket_timeout"] == 0.5
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_empty(self):
+        """Test lookup when nothing is cached."""
+        cache = SemanticCache()
+        cache._client = _redis_with_pipeline([None, {}])
+        
+        result = await cache.get_answer(1, [0.1] * 1536)
+        
+        assert result is None
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_zero_embedding(self):
+        """Test that an empty-query embedding never hits the cache."""
+        cache = SemanticCache()
+        cache._client = MagicMock()
+        
+        result = await cache.get_answer(1, [0.0] * 1536)
+        
+        assert result is None
+        cache._client.pipeline.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_exact_hit(self):
+        """Test that an identical embedding is answered without scanning sketches."""
+        cache = SemanticCache()
+        cache._client = _redis_with_pipeline([json.dumps({"answer": "Cached", "sources": []}), {}])
+        
+        result = await cache.get_answer(1, [0.1] * 1536)
+        
+        assert result == {"answer": "Cached", "sources": []}
+        assert cache._client.pipeline.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_hit(self):
+        """Test that a near-identical embedding returns the cached answer."""
+        stored = np.full(1536, 0.1, dtype=np.float32)
+        sketch = SemanticCache._sketch(stored).astype(np.float16).tobytes()
+        cache = SemanticCache()
+        cache._client = _redis_with_pipeline(
+            [None, {b"entry": sketch}],
+            [stored.tobytes(), json.dumps({"answer": "Cached", "sources": []})]
+        )
+        
+        result = await cache.get_answer(1, [0.1] * 1535 + [0.11])
+        
+        assert result == {"answer": "Cached", "sources": []}
+        pipe = cache._client.pipeline.return_value.__aenter__.return_value
+        pipe.hgetall.assert_called_once_with("semantic_cache:1:sketches")
+        pipe.hget.assert_called_with("semantic_cache:1:answers", b"entry")
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_below_threshold(self):
+        """Test that dissimilar embeddings miss without fetching the full embedding."""
+        stored = np.zeros(1536, dtype=np.float32)
+        stored[0] = 1.0
+        query = [0.0] * 1536
+        query[1] = 1.0
+        cache = SemanticCache()
+        cache._client = _redis_with_pipeline(
+            [None, {b"entry": SemanticCache._sketch(stored).astype(np.float16).tobytes()}]
+        )
+        
+        result = await cache.get_answer(1, query)
+        
+        assert result is None
+        assert cache._client.pipeline.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_sketch_match_confirmed_on_full_embedding(self):
+        """Test that a sketch match differing in the tail dimensions misses."""
+        stored = np.full(1536, 0.1, dtype=np.float32)
+        query = np.full(1536, 0.1, dtype=np.float32)
+        query[256:] = -0.1
+        cache = SemanticCache()
+        cache._client = _redis_with_pipeline(
+            [None, {b"entry": SemanticCache._sketch(stored).astype(np.float16).tobytes()}],
+            [stored.tobytes(), json.dumps({"answer": "Cached", "sources": []})]
+        )
+        
+        result = await cache.get_answer(1, query.tolist())
+        
+        assert result is None
+        assert cache._client.pipeline.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_get_answer_redis_error(self):
+        """Test that Redis failures are treated as a miss."""
+        cache = SemanticCache()
+        cache._client = MagicMock()
+        cache._client.pipeline.side_effect = ConnectionError("down")
+        
+        result = await cache.get_answer(1, [0.1] * 1536)
+        
+        assert result is None
+    
+    @pytest.mark.asyncio
+    async def test_invalidate_clears_document_and_all_scopes(self):
+        """Test that invalidation unlinks every key of the document and all-documents scopes."""
+        keys = {
+            "semantic_cache:3:*": [b"semantic_cache:3:answers", b"semantic_cache:3:context:5:abc"],
+            "semantic_cache:all:*": []
+        }
+        
+        async def scan_iter(match):
+            for key in keys[match]:
+                yield key
+        
+        cache = SemanticCache()
+        cache._client = MagicMock(scan_iter=scan_iter, unlink=AsyncMock())
+        
+        await cache.invalidate(3)
+        
+        cache._client.unlink.assert_called_once_with(*keys["semantic_cache:3:*"])
+    
+    @pytest.mark.asyncio
+    async def test_get_context_hit(self):
+        """Test cached context lookup by exact embedding."""
+        context = [{"id": 1, "content": "Cached chunk"}]
+        cache = SemanticCache()
+        cache._client = MagicMock(get=AsyncMock(return_value=json.dumps(context)))
+        
+        result = await cache.get_context(None, [0.1] * 1536, 5)
+        
+        assert result == context
+        key = cache._client.get.call_args[0][0]
+        assert key.startswith("semantic_cache:all:context:5:")
@@ -1,10 +1,11 @@
 """
 Unit tests for VectorStore service.
 """
+import asyncio
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
-from app.services.vector_store import VectorStore
-from app.models.document import Document, DocumentChunk, DocumentImage, DocumentTable
+from app.services.vector_store import VectorStore, ZERO_EMBEDDING, _halfvec_literals, _query_embedding_cache
+from app.models.document import DocumentChunk, DocumentImage, DocumentTable
 
 
 class TestVectorStore:
@@ -46,22 +47,14 @@ class TestVectorStore:
         mock_openai_embedding.embeddings.create.assert_called_once()
     
     @pytest.mark.asyncio
-    async def test_store_chunk(self, db_session, mock_openai_embedding):
+    async def test_store_chunk(self, db_session, sample_document, mock_openai_embedding):
         """Test storing a text chunk with embedding."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="completed"
-        )
-        db_session.add(document)
-        db_session.commit()
-        
         store = VectorStore(db_session)
         store._client = mock_openai_embedding
         
         chunk = await store.store_chunk(
             content="Test content",
-            document_id=document.id,
+            document_id=sample_document.id,
             page_number=1,
             chunk_index=0,
             metadata={"test": "value"}
@@ -69,31 +62,125 @@ class TestVectorStore:
         
         assert chunk is not None
         assert chunk.content == "Test content"
-        assert chunk.document_id == document.id
+        assert chunk.document_id == sample_document.id
         assert chunk.page_number == 1
         assert chunk.chunk_index == 0
     
+    @pytest.mark.asyncio
+    async def test_generate_embeddings_batch(self, db_session, mocker):
+        """Test batched embeddings keep order and skip empty texts."""
+        store = VectorStore(db_session)
+        store._client = mocker.MagicMock()
+        store._client.embeddings.create = AsyncMock(side_effect=lambda model, input: MagicMock(
+            data=[MagicMock(embedding=[float(len(t))] * 1536) for t in input]
+        ))
+        mocker.patch("app.services.vector_store.settings.EMBEDDING_BATCH_SIZE", 2)
+        
+        embeddings = await store.generate_embeddings_batch(["a", "", "bbb", "cc"])
+        
+        assert [e[0] for e in embeddings] == [1.0, 0.0, 3.0, 2.0]
+        assert store._client.embeddings.create.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_store_chunks_bulk(self, db_session, sample_document, mock_openai_embedding):
+        """Test storing several chunks with one embedding request."""
+        store = VectorStore(db_session)
+        store._client = mock_openai_embedding
+        mock_openai_embedding.embeddings.create.return_value.data = [
+            MagicMock(embedding=[0.1] * 1536) for _ in range(3)
+        ]
+        
+        stored = await store.store_chunks_bulk(
+            [
+                {"content": f"Chunk {i}", "page_number": 1, "chunk_index": i, "metadata": {}}
+                for i in range(3)
+            ],
+            sample_document.id
+        )
+        
+        assert stored == 3
+        assert db_session.query(DocumentChunk).filter_by(document_id=sample_document.id).count() == 3
+        mock_openai_embedding.embeddings.create.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_generate_embeddings_batch_dedupes(self, db_session, mocker):
+        """Test that repeated texts are embedded once and share the result."""
+        store = VectorStore(db_session)
+        store._client = mocker.MagicMock()
+        store._client.embeddings.create = AsyncMock(side_effect=lambda model, input: MagicMock(
+            data=[MagicMock(embedding=[float(len(t))] * 1536) for t in input]
+        ))
+        
+        embeddings = await store.generate_embeddings_batch(["footer", "body text", "footer", " "])
+        
+        assert store._client.embeddings.create.call_args.kwargs["input"] == ["footer", "body text"]
+        assert embeddings[0] is embeddings[2]
+        assert embeddings[3] is ZERO_EMBEDDING
+    
+    def test_halfvec_literals_round_trip(self):
+        """Test that preformatted halfvec literals decode to the same fp16 values."""
+        import numpy as np
+        from app.models.document import HalfVec
+        
+        embeddings = [[0.1, -0.25, 3e-5], [1.0, 0.0, -0.0123]]
+        literals = _halfvec_literals(embeddings)
+        bind = HalfVec(3).bind_processor(None)
+        bound = [bind(lit) for lit in literals]
+        
+        assert bound == literals
+        assert bind([0.5, 0.25, 1.0]) == "[0.5,0.25,1.0]"
+        
+        decoded = np.array([b[1:-1].split(",") for b in bound], dtype=np.float16)
+        assert np.array_equal(decoded, np.asarray(embeddings, dtype=np.float16))
+        assert _halfvec_literals([]) == []
+    
+    @pytest.mark.asyncio
+    async def test_similarity_search_scores_from_distance(self, db_session, mocker):
+        """Test that search orders by raw distance and scores in Python."""
+        store = VectorStore(db_session)
+        row = MagicMock(id=1, document_id=2, content="c", page_number=1, chunk_index=0,
+                        metadata=None, distance=0.25)
+        execute = mocker.patch.object(db_session, "execute")
+        execute.return_value.fetchall.return_value = [row]
+        store.get_related_content = AsyncMock(return_value={})
+        
+        results = await store.similarity_search("q", document_id=2, query_embedding=[0.1] * 1536)
+        
+        sql = str(execute.call_args.args[0])
+        assert "ORDER BY distance" in sql
+        assert results[0]["score"] == 0.75
+        assert results[0]["related_images"] == []
+    
+    @pytest.mark.asyncio
+    async def test_similarity_search_ranks_document_chunks_exactly(self, db_session, mocker):
+        """Test that only the unfiltered search is left to the approximate HNSW index."""
+        store = VectorStore(db_session)
+        execute = mocker.patch.object(db_session, "execute")
+        execute.return_value.fetchall.return_value = []
+        store.get_related_content = AsyncMock(return_value={})
+        
+        await store.similarity_search("q", document_id=2, query_embedding=[0.1] * 1536)
+        filtered = str(execute.call_args.args[0])
+        await store.similarity_search("q", query_embedding=[0.1] * 1536)
+        unfiltered = str(execute.call_args.args[0])
+        
+        # A post-filtered HNSW scan can miss a document's chunks entirely
+        assert "AS MATERIALIZED" in filtered and "WHERE document_id" in filtered
+        assert "MATERIALIZED" not in unfiltered
+    
     @pytest.mark.asyncio
     async def test_get_related_content_empty(self, db_session):
         """Test getting related content with no chunks."""
         store = VectorStore(db_session)
         result = await store.get_related_content([])
         
-        assert result == {"images": [], "tables": []}
+        assert result == {}
     
     @pytest.mark.asyncio
-    async def test_get_related_content_with_images(self, db_session):
+    async def test_get_related_content_with_images(self, db_session, sample_document):
         """Test getting related content with images."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="completed"
-        )
-        db_session.add(document)
-        db_session.commit()
-        
         image = DocumentImage(
-            document_id=document.id,
+            document_id=sample_document.id,
             file_path="/tmp/images/test.png",
             page_number=1,
             caption="Test image",
@@ -101,52 +188,127 @@ class TestVectorStore:
             height=100
         )
         db_session.add(image)
-        db_session.commit()
+        db_session.flush()
         
         chunk = DocumentChunk(
-            document_id=document.id,
+            document_id=sample_document.id,
             content="Test content",
             page_number=1,
             chunk_index=0,
             chunk_metadata={"related_images": [image.id]}
         )
         db_session.add(chunk)
-        db_session.commit()
+        db_session.flush()
         
         store = VectorStore(db_session)
         result = await store.get_related_content([chunk.id])
         
-        assert len(result["images"]) == 1
-        assert result["images"][0]["id"] == image.id
+        assert len(result[chunk.id]["images"]) == 1
+        assert result[chunk.id]["images"][0]["id"] == image.id
+        assert result[chunk.id]["images"][0]["url"] == "/uploads/images/test.png"
     
     @pytest.mark.asyncio
-    async def test_delete_document_chunks(self, db_session, mock_openai_embedding):
-        """Test deleting all chunks for a document."""
-        document = Document(
-            filename="test.pdf",
-            file_path="/tmp/test.pdf",
-            processing_status="completed"
-        )
-        db_session.add(document)
-        db_session.commit()
+    async def test_get_related_content_groups_by_chunk(self, db_session, sample_document):
+        """Test that media is fetched once and bucketed per chunk."""
+        images = [
+            DocumentImage(document_id=sample_document.id, file_path=f"/tmp/images/{page}.png", page_number=page)
+            for page in (1, 2)
+        ]
+        table = DocumentTable(document_id=sample_document.id, image_path="/tmp/tables/t.svg", page_number=2)
+        db_session.add_all(images + [table])
+        db_session.flush()
+        
+        chunks = [
+            DocumentChunk(document_id=sample_document.id, content="a", page_number=1, chunk_index=0,
+                          chunk_metadata={"related_images": [images[1].id]}),
+            DocumentChunk(document_id=sample_document.id, content="b", page_number=2, chunk_index=1,
+                          chunk_metadata={})
+        ]
+        db_session.add_all(chunks)
+        db_session.flush()
         
+        store = VectorStore(db_session)
+        result = await store.get_related_content([c.id for c in chunks])
+        
+        assert [img["id"] for img in result[chunks[0].id]["images"]] == [images[1].id]
+        assert result[chunks[0].id]["tables"] == []
+        assert [img["id"] for img in result[chunks[1].id]["images"]] == [images[1].id]
+        assert [tbl["id"] for tbl in result[chunks[1].id]["tables"]] == [table.id]
+    
+    @pytest.mark.asyncio
+    async def test_delete_document_chunks(self, db_session, sample_document, mock_openai_embedding):
+        """Test deleting all chunks for a document."""
         store = VectorStore(db_session)
         store._client = mock_openai_embedding
         
-        await store.store_chunk("Chunk 1", document.id, 1, 0)
-        await store.store_chunk("Chunk 2", document.id, 1, 1)
-        await store.store_chunk("Chunk 3", document.id, 2, 0)
+        # Session work happens after each embedding await, so the calls never interleave on it
+        await asyncio.gather(
+            store.store_chunk("Chunk 1", sample_document.id, 1, 0),
+            store.store_chunk("Chunk 2", sample_document.id, 1, 1),
+            store.store_chunk("Chunk 3", sample_document.id, 2, 0)
+        )
         
         chunks_before = db_session.query(DocumentChunk).filter(
-            DocumentChunk.document_id == document.id
+            DocumentChunk.document_id == sample_document.id
         ).count()
         assert chunks_before == 3
         
-        deleted = await store.delete_document_chunks(document.id)
+        deleted = await store.delete_document_chunks(sample_document.id)
         assert deleted == 3
         
         chunks_after = db_session.query(DocumentChunk).filter(
-            DocumentChunk.document_id == document.id
+            DocumentChunk.document_id == sample_document.id
         ).count()
         assert chunks_after == 0
 
+    
+    @pytest.mark.asyncio
+    async def test_embed_query_empty(self, db_session):
+        """Test query embedding with empty text skips the API."""
+        store = VectorStore(db_session)
+        embedding = await store.embed_query("  ")
+        
+        assert len(embedding) == 1536
+        assert all(v == 0.0 for v in embedding)
+    
+    @pytest.mark.asyncio
+    async def test_embed_query_batches_concurrent_calls(self, db_session):
+        """Test that concurrent query embeddings share one API request."""
+        mock_client = MagicMock()
+        mock_client.embeddings.create = AsyncMock(side_effect=lambda model, input: MagicMock(
+            data=[MagicMock(embedding=[float(i)] * 1536) for i in range(len(input))]
+        ))
+        store = VectorStore(db_session)
+        _query_embedding_cache.clear()
+        
+        with patch("app.services.vector_store.get_openai_client", return_value=mock_client):
+            results = await asyncio.gather(
+                store.embed_query("first"),
+                store.embed_query("second"),
+                store.embed_query("third"),
+            )
+        
+        mock_client.embeddings.create.assert_called_once()
+        assert mock_client.embeddings.create.call_args.kwargs["input"] == ["first", "second", "third"]
+        assert [r[0] for r in results] == [0.0, 1.0, 2.0]
+    
+    @pytest.mark.asyncio
+    async def test_embed_query_reuses_cached_embedding(self, db_session, mocker):
+        """Test that repeated queries are embedded once and the cache is bounded."""
+        mock_client = MagicMock()
+        mock_client.embeddings.create = AsyncMock(side_effect=lambda model, input: MagicMock(
+            data=[MagicMock(embedding=[float(len(t))] * 1536) for t in input]
+        ))
+        mocker.patch("app.services.vector_store.settings.QUERY_EMBEDDING_CACHE_SIZE", 2)
+        store = VectorStore(db_session)
+        _query_embedding_cache.clear()
+        
+        with patch("app.services.vector_store.get_openai_client", return_value=mock_client):
+            first = await store.embed_query("repeat")
+            second = await store.embed_query("repeat")
+            await store.embed_query("other")
+            await store.embed_query("third")
+        
+        assert first == second
+        assert mock_client.embeddings.create.call_count == 3
+        assert list(_query_embedding_cache) == ["other", "third"]